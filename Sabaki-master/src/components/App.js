@@ -32,6 +32,7 @@ class App extends Component {
     initConnection() {
         
         let app = this
+        this.remoteVariation = null
         
         console.log("~~~~~~ Opening connection ~~~~~~")
         this.websocket = new WebSocket("ws://127.0.0.1:4257")
@@ -41,20 +42,15 @@ class App extends Component {
             this.send("Connection open !")
         }
         
+        // Loading a full sgf takes a while, the messages following it are only applied to the tree it loads
+        this.remoteUpdates = Promise.resolve()
+
         this.websocket.onmessage = function(ev) {
             let msg = JSON.parse(ev.data)
-            let action = msg["action"]
-            console.log("got message " + action)
-            if (action === "play") {
-               app.loadContent(msg["data"], "sgf", {suppressAskForSave: true})
-            } else if (action === "close") {
-                console.log("Closing Sabaki ...")
-                this.send("Closing Sabaki")
-                app.detachEngines()
-                app.closeWindow = true
-                app.window.close()
-                app.quit()
-            }
+            console.log("got message " + msg["action"])
+            app.remoteUpdates = app.remoteUpdates
+                .then(() => app.handleRemoteMessage(msg))
+                .catch(err => console.log("Couldn't apply " + msg["action"] + " : " + err))
         }
         
         this.websocket.onclose = function(ev) {
@@ -1263,6 +1259,96 @@ class App extends Component {
         }, setting.get('edit.undo_delay'))
     }
 
+    // Remote updates
+
+    handleRemoteMessage(msg) {
+        let action = msg["action"]
+        if (action === "play") {
+            this.remoteVariation = null
+            return this.loadContent(msg["data"], "sgf", {suppressAskForSave: true})
+        } else if (action === "append") {
+            this.appendMainLineMoves(msg["nodes"])
+        } else if (action === "variation") {
+            this.showRemoteVariation(msg["from"], msg["nodes"])
+        } else if (action === "mainline") {
+            this.returnToMainLine()
+        } else if (action === "close") {
+            console.log("Closing Sabaki ...")
+            this.websocket.send("Closing Sabaki")
+            this.detachEngines()
+            this.closeWindow = true
+            this.window.close()
+            this.quit()
+        }
+    }
+
+    appendMainLineMoves(nodes) {
+        let tree = gametree.getRoot(...this.state.treePosition)
+
+        while (tree.subtrees.length !== 0) {
+            tree.current = 0
+            tree = tree.subtrees[0]
+        }
+
+        tree.nodes.push(...nodes)
+        this.setCurrentTreePosition(tree, tree.nodes.length - 1)
+    }
+
+    showRemoteVariation(from, nodes) {
+        this.removeRemoteVariation()
+
+        let root = gametree.getRoot(...this.state.treePosition)
+        let t = root
+
+        while (t.subtrees.length !== 0) {
+            t.current = 0
+            t = t.subtrees[0]
+        }
+
+        let treePosition = gametree.navigate(root, 0, from)
+        if (!treePosition) return
+
+        let [tree, index] = treePosition
+        let updateRoot = tree.parent == null
+        let splitted = gametree.split(tree, index)
+        let newTree = gametree.new()
+
+        newTree.nodes = nodes
+        newTree.parent = splitted
+
+        splitted.subtrees.push(newTree)
+        splitted.current = splitted.subtrees.length - 1
+
+        if (updateRoot) {
+            let {gameTrees} = this.state
+            gameTrees[gameTrees.indexOf(tree)] = splitted
+        }
+
+        this.remoteVariation = newTree
+        this.setCurrentTreePosition(newTree, nodes.length - 1)
+    }
+
+    removeRemoteVariation() {
+        let tree = this.remoteVariation
+        if (!tree) return
+
+        this.remoteVariation = null
+
+        let parent = tree.parent
+        parent.subtrees.splice(parent.subtrees.indexOf(tree), 1)
+        parent.current = parent.subtrees.length === 0 ? null : 0
+
+        gametree.reduce(parent)
+    }
+
+    returnToMainLine() {
+        let root = gametree.getRoot(...this.state.treePosition)
+
+        this.removeRemoteVariation()
+        this.setCurrentTreePosition(root, 0)
+        this.goToEnd()
+    }
+
     // Navigation
 
     setCurrentTreePosition(tree, index, {clearUndoPoint = true} = {}) {
@@ -1,52 +1,63 @@
 import os
-from threading import Thread
-from collections import deque
+import io
 import time
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import PIL, PIL.ImageDraw, PIL.ImageFont
 
 from util import trace, settings
 from go_game import COLOR_BLACK, COLOR_WHITE
 
-class OverlayTimer(Thread):
+# OBS may have the overlay open for reading, which makes replacing it fail on windows for a short while
+PUBLISH_ATTEMPTS = 5
+PUBLISH_RETRY_DELAY = 0.02
 
-    def __init__(self, generator):
-        super(OverlayTimer, self).__init__()
-        self.generator = generator
-        self.images = deque([])
-        self.running = False
+def replaceFile(tempPath, path):
+    try:
+        os.replace(tempPath, path)
+    except AttributeError: # python 2
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(tempPath, path)
 
-    def addImage(self, image, t):
-        self.images.append( (image, t) )
-        
-    def resetOverlay(self):
-        trace("Clearing on-screen variation", 1)
-        self.generator.ovBaseImage.save(self.generator.ovImagePath)
+def publishFile(path, data):
+    """ Writes a file through a temporary file renamed over it, so that readers such as OBS never see it half written.
+        Gives whether it was published, the temporary file is left for the next publish otherwise. """
+    tempPath = path + ".tmp"
+    try:
+        with open(tempPath, "wb") as f:
+            f.write(data)
+    except (IOError, OSError) as e:
+        trace("Couldn't write %s : %s" % (tempPath, e), 0)
+        return False
+    for attempt in range(PUBLISH_ATTEMPTS):
+        try:
+            replaceFile(tempPath, path)
+            return True
+        except OSError as e:
+            error = e
+            time.sleep(PUBLISH_RETRY_DELAY)
+    trace("Couldn't publish %s : %s" % (path, error), 0)
+    return False
 
-    def setOverlay(self, image):
-        trace("New on-screen variation", 1)
-        image.save(self.generator.ovImagePath)
-    
-    def nextOverlay(self):
-        if len(self.images) == 0:
-            self.resetOverlay()
-            return
-        image, t = self.images.popleft()
-        self.setOverlay(image)
-        time.sleep(t)
-    
-    def start(self):
-        if not self.running:
-            super(OverlayTimer, self).start()
-    
-    def run(self):
-        self.running = True
-        while len(self.images) > 0:
-            self.nextOverlay()
-        self.resetOverlay()
-        self.running = False
+def textSize(drawContext, text, font):
+    """ Size of a text, with a fallback for Pillow versions that removed ImageDraw.textsize """
+    try:
+        return drawContext.textsize(text, font=font)
+    except AttributeError:
+        left, top, right, bottom = drawContext.textbbox( (0, 0), text, font=font)
+        return (right, bottom)
+
+# Styles of the stones drawn on the overlay
+STYLE_BLACK = 0
+STYLE_WHITE = 1
+STYLE_MARKER = 2
 
 class VariationOverlayGenerator:
+    """ Draws variations by pasting sprites of the stones and their move numbers on a transparent image.
+        The sprites are drawn at a higher resolution then scaled down once, the first time they are used. """
     
     def __init__(self):
         self.ovImagePath = settings["overlay_image_path"]
@@ -62,67 +73,150 @@ class VariationOverlayGenerator:
         fontPath = os.path.join(".", "overlay", "fonts", "steelfis.ttf") # https://fontlibrary.org/en/font/steelfish
         self.ovFont = PIL.ImageFont.truetype(fontPath, size=52 * self.antialias)
         
+        # Every intersection has the same size once scaled down, so that a single sprite fits all of them
+        self.spriteSize = (int(round(self.ovDimensions[0] / 19.0 / self.antialias)), int(round(self.ovDimensions[1] / 19.0 / self.antialias)))
+        self.sprites = {}
+        self.spritesLock = Lock()
+        
+        # Overlays are rendered in the background so that the chat keeps being read meanwhile
+        self.renderPool = ThreadPoolExecutor(max_workers=settings["overlay_render_workers"])
+        
+        # Encoded overlays of recent variations, most recently used last
+        self.compressLevel = settings["overlay_png_compress_level"]
+        self.cacheSize = settings["overlay_cache_size"]
+        self.cache = OrderedDict()
+        self.cacheLock = Lock()
+        
         # Initialize empty overlay image
         self.ovBaseImage = PIL.Image.new(mode="RGBA", size=self.ovBaseImageSize, color=(0, 0, 0, 0))
-        self.ovBaseImage.save(self.ovImagePath)
+        self.ovBaseImageData = self.encodeImage(self.ovBaseImage)
+        publishFile(self.ovImagePath, self.ovBaseImageData)
         
-        self.timer = OverlayTimer(self)
-        self.baseTimeVariation = int(settings["base_variation_displaying_time"])
-        self.timePerStone = int(settings["variation_displaying_time_per_stone"])
+        # Variation currently displayed, so that an image finishing its rendering after its time is up isn't published
+        self.shownEntry = None
+        self.publishLock = Lock()
+        # Writing the file can block for a while, it is done away from the event loop by a single thread which keeps the publishing order
+        self.publishPool = ThreadPoolExecutor(max_workers=1)
         
-    def generateOverlay(self, variation, user, colors=False):
-        trace("Generating Overlay image for variation %s" % variation, 2)
-        drawSize = (self.ovBaseImageSize[0] * self.antialias, self.ovBaseImageSize[1] * self.antialias)
-        output = PIL.Image.new(mode="RGBA", size=drawSize, color=(0, 0, 0, 0))
-        drawContext = PIL.ImageDraw.Draw(output)
+    def spritePosition(self, x, y):
+        """ Top left corner of the given intersection on the overlay """
+        left = self.ovTopleft[0] + self.ovDimensions[0] * x / 19.0
+        top = self.ovTopleft[1] + self.ovDimensions[1] * y / 19.0
+        return (int(round(left / self.antialias)), int(round(top / self.antialias)))
+        
+    def getSprite(self, style, moveNumber):
+        """ Sprite of a stone with its move number, drawn the first time it is needed """
+        key = (style, moveNumber)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            with self.spritesLock:
+                sprite = self.sprites.get(key)
+                if sprite is None:
+                    sprite = self.drawSprite(style, moveNumber)
+                    self.sprites[key] = sprite
+        return sprite
+        
+    def drawSprite(self, style, moveNumber):
+        trace("Drawing overlay sprite for move %d" % moveNumber, 3)
+        drawSize = (self.spriteSize[0] * self.antialias, self.spriteSize[1] * self.antialias)
+        sprite = PIL.Image.new(mode="RGBA", size=drawSize, color=(0, 0, 0, 0))
+        drawContext = PIL.ImageDraw.Draw(sprite)
+        
+        offset = self.antialias * 3
+        left, top = offset, offset
+        right, bottom = drawSize[0] - offset, drawSize[1] - offset
+        
+        # Draw an outlined circle
+        if style == STYLE_BLACK:
+            drawContext.ellipse( (left, top, right, bottom), outline="white", fill="white" )
+            drawContext.ellipse( (left + offset, top + offset, right - offset, bottom - offset), outline="black", fill="black" )
+        elif style == STYLE_WHITE:
+            drawContext.ellipse( (left, top, right, bottom), outline="black", fill="black" )
+            drawContext.ellipse( (left + offset, top + offset, right - offset, bottom - offset), outline="white", fill="white" )
+        else:
+            drawContext.ellipse( (left + offset*6, top + offset*6, right - offset*6, bottom - offset*6), outline="black", fill="black" )
+            drawContext.ellipse( (left + offset*7, top  + offset*7, right - offset*7, bottom - offset*7), outline=(205,200,60,0), fill=(205,200,60,0) )
+        
+        # Draw the move number, outlined
+        text = str(moveNumber)
+        w, h = textSize(drawContext, text, self.ovFont)
+        W = right - left
+        H = bottom - top
+        textX = left + self.antialias + (W - w) / 2
+        textY = top - self.antialias + (H - h) / 2
+        for dx, dy in ( (-1, -1), (1, -1), (-1, 1), (1, 1), (-1, 0), (1, 0), (0, -1), (0, 1) ):
+            drawContext.text( (textX + dx * offset, textY + dy * offset), text, font=self.ovFont, fill="black")
+        drawContext.text( (textX, textY), text, font=self.ovFont, fill="white")
+        
+        return sprite.resize(self.spriteSize, PIL.Image.LANCZOS)
+        
+    def renderOverlay(self, variation, colors=False):
+        """ Gives the overlay image for a variation """
+        output = self.ovBaseImage.copy()
         for i in range(len(variation)):
             move, color = variation[i]
-            x, y = move
-            
-            offset = self.antialias * 3
-            
-            left = self.ovTopleft[0] + self.ovDimensions[0] * x / 19 + offset
-            top = self.ovTopleft[1] + self.ovDimensions[1] * y / 19 + offset
-            right = self.ovTopleft[0] + self.ovDimensions[0] * (x + 1) / 19 - offset
-            bottom = self.ovTopleft[1] + self.ovDimensions[1] * (y + 1) / 19 - offset
-            
-            # Draw an outlined circle
             if colors:
-                if color == COLOR_BLACK:
-                    drawContext.ellipse( (left, top, right, bottom), outline="white", fill="white" )
-                    drawContext.ellipse( (left + offset, top + offset, right - offset, bottom - offset), outline="black", fill="black" )
-                else:
-                    drawContext.ellipse( (left, top, right, bottom), outline="black", fill="black" )
-                    drawContext.ellipse( (left + offset, top + offset, right - offset, bottom - offset), outline="white", fill="white" )
+                style = STYLE_BLACK if color == COLOR_BLACK else STYLE_WHITE
             else:
-                drawContext.ellipse( (left + offset*6, top + offset*6, right - offset*6, bottom - offset*6), outline="black", fill="black" )
-                drawContext.ellipse( (left + offset*7, top  + offset*7, right - offset*7, bottom - offset*7), outline=(205,200,60,0), fill=(205,200,60,0) )
-            
-            # Draw the move number
-            moveNumber = str(i+1)
-            w, h = drawContext.textsize(moveNumber, font=self.ovFont)
-            W = right - left
-            H = bottom - top
-            textX = left + self.antialias + (W - w) / 2
-            textY = top - self.antialias + (H - h) / 2
-            drawContext.text( (textX - offset, textY - offset), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX + offset, textY - offset), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX - offset, textY + offset), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX + offset, textY + offset), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX - offset, textY), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX + offset, textY), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX, textY - offset), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX, textY + offset), moveNumber, font=self.ovFont, fill="black")
-            drawContext.text( (textX, textY), moveNumber, font=self.ovFont, fill="white")
-        
-        output = output.resize(self.ovBaseImageSize, PIL.Image.LANCZOS)
-        # output.save(self.ovImagePath)
-        
-        t = self.baseTimeVariation + len(variation) * self.timePerStone
-        if self.timer.running:
-            self.timer.addImage(output, t)
-        else:
-            self.timer = OverlayTimer(self)
-            self.timer.addImage(output, t)
-            self.timer.start()
-    
\ No newline at end of file
+                style = STYLE_MARKER
+            # Pasting without a mask replaces the whole intersection, like drawing over it did
+            output.paste(self.getSprite(style, i+1), self.spritePosition(*move))
+        return output
+        
+    def encodeImage(self, image):
+        data = io.BytesIO()
+        image.save(data, format="PNG", compress_level=self.compressLevel)
+        return data.getvalue()
+        
+    def encodeOverlay(self, variation, colors=False):
+        """ Gives the png data of the overlay for a variation, only rendering it if it isn't in the cache """
+        key = (tuple(variation), colors, self.ovTopleft, self.ovDimensions, self.ovBaseImageSize)
+        with self.cacheLock:
+            data = self.cache.pop(key, None)
+            if data is not None:
+                trace("Overlay found in cache", 2)
+                self.cache[key] = data
+                return data
+        data = self.encodeImage(self.renderOverlay(variation, colors))
+        with self.cacheLock:
+            self.cache[key] = data
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        return data
+        
+    def generateOverlay(self, variation, user, colors=False):
+        """ Starts rendering the overlay of a variation in the background, gives the future png data """
+        trace("Generating Overlay image for variation %s" % variation, 2)
+        return self.renderPool.submit(self.encodeOverlay, variation, colors)
+        
+    def showVariation(self, entry):
+        """ Called by the display scheduler when a variation begins, the image is published as soon as it is rendered """
+        with self.publishLock:
+            self.shownEntry = entry
+        # The callback runs right away in this thread when the image is already rendered, so it only hands it over to the publishing thread
+        entry.overlayImage.add_done_callback(lambda image: self.publishPool.submit(self.publishOverlay, entry, image))
+        
+    def publishOverlay(self, entry, image):
+        try:
+            data = image.result()
+        except Exception as e:
+            trace("Couldn't render the overlay : %s" % e, 0)
+            return
+        with self.publishLock:
+            if self.shownEntry is not entry:
+                return
+        trace("New on-screen variation", 1)
+        publishFile(self.ovImagePath, data)
+        
+    def clearVariation(self):
+        """ Called by the display scheduler when no variation is displayed anymore """
+        with self.publishLock:
+            self.shownEntry = None
+        self.publishPool.submit(self.publishEmptyOverlay)
+        
+    def publishEmptyOverlay(self):
+        with self.publishLock:
+            if self.shownEntry is not None:
+                return
+        trace("Clearing on-screen variation", 1)
+        publishFile(self.ovImagePath, self.ovBaseImageData)
@@ -0,0 +1,84 @@
+import os
+
+import tornado.httpserver
+import tornado.websocket
+import tornado.web
+import simplejson as json
+
+from util import trace, settings
+from event_loop import callInEventLoop
+
+OVERLAY_DIRECTORY = os.path.join(".", "overlay")
+
+class BrowserOverlay:
+    """ Sends the variations to the overlay page opened as a browser source in OBS, which draws them itself.
+        Only used from the event loop, the display scheduler decides when variations are shown. """
+
+    def __init__(self):
+        self.clients = set()
+        self.current = None
+
+        # Same geometry as the png overlay, whose padding is given for a 4 times bigger image
+        size = 1520
+        left, top = int(settings["overlay_padding_left"]) / 4.0, int(settings["overlay_padding_top"]) / 4.0
+        right, bottom = int(settings["overlay_padding_right"]) / 4.0, int(settings["overlay_padding_bottom"]) / 4.0
+        self.config = {"action": "config", "size": [size, size], "topleft": [left, top], "dimensions": [size - left - right, size - top - bottom]}
+
+    def addClient(self, client):
+        self.clients.add(client)
+        client.write_message(self.encode(self.config))
+        if self.current is not None:
+            client.write_message(self.encode(self.current))
+
+    def removeClient(self, client):
+        self.clients.discard(client)
+
+    def encode(self, message):
+        return json.dumps(message, separators=(",", ":") )
+
+    def broadcast(self, message):
+        data = self.encode(message)
+        for client in list(self.clients):
+            try:
+                client.write_message(data)
+            except tornado.websocket.WebSocketClosedError:
+                self.clients.discard(client)
+
+    def showVariation(self, entry):
+        trace("New on-screen variation", 1)
+        moves = [ [move[0], move[1], color] for move, color in entry.moves ]
+        self.current = {"action": "show", "moves": moves, "colors": entry.colors, "user": entry.user}
+        self.broadcast(self.current)
+
+    def clearVariation(self):
+        trace("Clearing on-screen variation", 1)
+        self.current = None
+        self.broadcast({"action": "clear"})
+
+overlayInstance = BrowserOverlay()
+
+class OverlayWSHandler(tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        trace("Overlay browser source connected", 0)
+        overlayInstance.addClient(self)
+
+    def on_close(self):
+        trace("Overlay browser source disconnected", 0)
+        overlayInstance.removeClient(self)
+
+    def check_origin(self, origin):
+        return True
+
+def overlayRoutes():
+    """ The overlay page is served at /overlay/browser_source.html, along with the font it uses """
+    return [ (r'/overlay/ws', OverlayWSHandler),
+             (r'/overlay/(.*)', tornado.web.StaticFileHandler, {"path": OVERLAY_DIRECTORY}), ]
+
+def startOverlayServer():
+    """ Serves the overlay on its own when Sabaki isn't used, otherwise the overlay shares Sabaki's server """
+    def listen():
+        server = tornado.httpserver.HTTPServer(tornado.web.Application(overlayRoutes()))
+        server.listen(4257, address="localhost")
+        return server
+    return callInEventLoop(listen)
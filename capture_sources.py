@@ -0,0 +1,174 @@
+import os
+
+import PIL, PIL.Image
+import numpy
+
+from util import trace, settings
+
+# ----- Sources of board images for the ScreenshotDaemon -----
+
+IMAGE_EXTENSIONS = (".png", ".bmp", ".jpg", ".jpeg")
+
+class CaptureSource:
+    """ Interface of the capture backends. A source finds the windows of the configured go servers, and gives a picture of the one
+        currently in use as an RGB (rows, columns, 3) uint8 array, which may be a view of the backend's own buffer. """
+    
+    # Realtime sources are polled at the capture rate, others are read as fast as possible
+    realtime = True
+    
+    def __init__(self, servers):
+        self.servers = servers
+        self.finished = False
+        
+    def findWindows(self):
+        """ Looks for the windows of the configured servers """
+        pass
+        
+    def grab(self):
+        """ Gives (server name, window key, frame) for the server window in use, or None if there is none """
+        raise NotImplementedError
+        
+    def close(self):
+        pass
+        
+def matchServer(servers, title):
+    """ Gives the name of the first server whose pattern is in the window title, or None """
+    title = title.lower()
+    for serv in servers:
+        if serv["pattern"] in title:
+            return serv["name"]
+    return None
+    
+def matchServerWindows(servers, windows):
+    """ Gives the first window whose title matches each server's pattern, from a list of (window, title) """
+    matched = {}
+    for serv in servers:
+        pattern = serv["pattern"]
+        for window, title in windows:
+            if pattern in title.lower():
+                matched[serv["name"]] = window
+                break
+        else:
+            trace("Couldn't find a window handle for server " + serv["name"], 2)
+    trace("\n#####\nServers found:\n%s\n#####\n" % str(list(matched.keys())), 1)
+    return matched
+    
+class WindowCaptureSource(CaptureSource):
+    """ Base of the sources that capture the active window. Window handles are cached : the full window list is only enumerated once,
+        cached handles are validated when they are used, and an unknown active window only has its own title checked. """
+    
+    def __init__(self, servers):
+        CaptureSource.__init__(self, servers)
+        self.windows = {}
+        
+    def listWindows(self):
+        """ Gives the list of (window, title) for all top-level windows """
+        raise NotImplementedError
+        
+    def activeWindow(self):
+        raise NotImplementedError
+        
+    def windowTitle(self, window):
+        raise NotImplementedError
+        
+    def isWindow(self, window):
+        raise NotImplementedError
+        
+    def captureWindow(self, window):
+        raise NotImplementedError
+        
+    def findWindows(self):
+        self.windows = matchServerWindows(self.servers, self.listWindows())
+        
+    def serverForWindow(self, window):
+        """ Gives the name of the server the window belongs to, updating the cache if needed, or None """
+        for name, serverWindow in self.windows.items():
+            if serverWindow == window:
+                if self.isWindow(window):
+                    return name
+                trace("Window of server %s was closed" % name, 1)
+                del self.windows[name]
+                return None
+        name = matchServer(self.servers, self.windowTitle(window))
+        if name is not None:
+            trace("Found new window %s for server %s" % (window, name), 1)
+            self.windows[name] = window
+        return name
+        
+    def grab(self):
+        window = self.activeWindow()
+        if window is None:
+            return None
+        name = self.serverForWindow(window)
+        if name is None:
+            return None
+        return (name, window, self.captureWindow(window))
+    
+class ReplayCaptureSource(CaptureSource):
+    """ Replays a directory of screenshots, in file name order, or a video file, as if they were captured from the given server's window """
+    
+    realtime = False
+    
+    def __init__(self, servers, path, serverName, preload=False):
+        CaptureSource.__init__(self, servers)
+        self.path = path
+        self.serverName = serverName
+        self.video = None
+        self.frames = None
+        self.index = 0
+        if os.path.isdir(path):
+            self.files = sorted([os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS)])
+            trace("Replaying %d frames from %s" % (len(self.files), path), 1)
+            if preload:
+                self.frames = [self.loadImage(f) for f in self.files]
+        else:
+            import cv2 # Only needed to replay videos
+            self.video = cv2.VideoCapture(path)
+            trace("Replaying video %s" % path, 1)
+            
+    def loadImage(self, path):
+        return numpy.asarray(PIL.Image.open(path).convert("RGB"))
+        
+    def nextFrame(self):
+        if self.video is not None:
+            ok, frame = self.video.read()
+            return frame[:, :, ::-1] if ok else None # BGR to RGB
+        if self.index >= len(self.files):
+            return None
+        if self.frames is not None:
+            frame = self.frames[self.index]
+        else:
+            frame = self.loadImage(self.files[self.index])
+        self.index += 1
+        return frame
+        
+    def grab(self):
+        frame = self.nextFrame()
+        if frame is None:
+            self.finished = True
+            return None
+        return (self.serverName, self.path, frame)
+        
+    def rewind(self):
+        if self.video is not None:
+            import cv2
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.index = 0
+        self.finished = False
+        
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+            
+def getCaptureSource():
+    """ Creates the capture backend selected in the settings """
+    sourceType = settings["capture_source"]
+    if sourceType == "windows":
+        from capture_win32 import Win32CaptureSource
+        return Win32CaptureSource(settings["servers"])
+    elif sourceType == "x11":
+        from capture_x11 import X11CaptureSource
+        return X11CaptureSource(settings["servers"])
+    elif sourceType == "replay":
+        return ReplayCaptureSource(settings["servers"], settings["replay_path"], settings["replay_server"])
+    raise ValueError("Unknown capture source %s" % sourceType)
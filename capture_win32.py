@@ -0,0 +1,83 @@
+from ctypes import windll
+
+import win32gui
+import win32ui
+import numpy
+
+from capture_sources import WindowCaptureSource
+from util import trace
+
+class Win32CaptureSource(WindowCaptureSource):
+    """ Captures the foreground window on Windows, if it belongs to one of the configured servers.
+        The device contexts and bitmap are kept across captures as long as the window and its size don't change. """
+    
+    def __init__(self, servers):
+        WindowCaptureSource.__init__(self, servers)
+        self.gdi = None
+        
+    def listWindows(self):
+        # ----- Get the go apps handles -----
+        winlist = []
+        def enum_cb(hwnd, results):
+            title = win32gui.GetWindowText(hwnd)
+            if title != "":
+                trace("Found window %s - %s " % (hwnd, title), 3)
+            winlist.append( (hwnd, title) )
+        win32gui.EnumWindows(enum_cb, None)
+        return winlist
+        
+    def activeWindow(self):
+        hwnd = win32gui.GetForegroundWindow()
+        return hwnd if hwnd != 0 else None
+        
+    def windowTitle(self, hwnd):
+        return win32gui.GetWindowText(hwnd)
+        
+    def isWindow(self, hwnd):
+        return win32gui.IsWindow(hwnd)
+        
+    def captureWindow(self, hwnd):
+        left, top, right, bot = win32gui.GetClientRect(hwnd)
+        w = right - left
+        h = bot - top
+        
+        if self.gdi is None or self.gdi["key"] != (hwnd, w, h):
+            self.releaseGdi()
+            hwndDC = win32gui.GetWindowDC(hwnd)
+            mfcDC  = win32ui.CreateDCFromHandle(hwndDC)
+            saveDC = mfcDC.CreateCompatibleDC()
+            
+            saveBitMap = win32ui.CreateBitmap()
+            saveBitMap.CreateCompatibleBitmap(mfcDC, w, h)
+
+            saveDC.SelectObject(saveBitMap)
+            self.gdi = {"key": (hwnd, w, h), "hwndDC": hwndDC, "mfcDC": mfcDC, "saveDC": saveDC, "saveBitMap": saveBitMap}
+            trace("Created capture bitmap for window %s - %dx%d" % (hwnd, w, h), 2)
+        
+        saveDC = self.gdi["saveDC"]
+        saveBitMap = self.gdi["saveBitMap"]
+        result = windll.user32.PrintWindow(hwnd, saveDC.GetSafeHdc(), 1)
+        
+        bmpinfo = saveBitMap.GetInfo()
+        bmpstr = saveBitMap.GetBitmapBits(True)
+        
+        return bitmapFrame(bmpstr, bmpinfo)
+        
+    def releaseGdi(self):
+        if self.gdi is None:
+            return
+        hwnd = self.gdi["key"][0]
+        win32gui.DeleteObject(self.gdi["saveBitMap"].GetHandle())
+        self.gdi["saveDC"].DeleteDC()
+        self.gdi["mfcDC"].DeleteDC()
+        win32gui.ReleaseDC(hwnd, self.gdi["hwndDC"])
+        self.gdi = None
+        
+    def close(self):
+        self.releaseGdi()
+        
+def bitmapFrame(bmpstr, bmpinfo):
+    """ Gives a raw 32 bits BGRX bitmap as an RGB (rows, columns, 3) array sharing the bitmap's memory """
+    rowLength = bmpinfo["bmWidthBytes"] // 4
+    frame = numpy.frombuffer(bmpstr, dtype=numpy.uint8).reshape(bmpinfo["bmHeight"], rowLength, 4)
+    return frame[:, :bmpinfo["bmWidth"], 2::-1]
@@ -0,0 +1,68 @@
+from Xlib import X, display
+import mss
+import numpy
+
+from capture_sources import WindowCaptureSource
+from util import trace
+
+class X11CaptureSource(WindowCaptureSource):
+    """ Captures the active window on Linux, if it belongs to one of the configured servers.
+        Windows are found through the window manager's EWMH properties, and their content is grabbed from the screen with mss. """
+    
+    def __init__(self, servers):
+        WindowCaptureSource.__init__(self, servers)
+        self.display = display.Display()
+        self.root = self.display.screen().root
+        self.NET_CLIENT_LIST = self.display.intern_atom("_NET_CLIENT_LIST")
+        self.NET_ACTIVE_WINDOW = self.display.intern_atom("_NET_ACTIVE_WINDOW")
+        self.NET_WM_NAME = self.display.intern_atom("_NET_WM_NAME")
+        self.screen = mss.mss()
+        
+    def window(self, windowId):
+        return self.display.create_resource_object("window", windowId)
+        
+    def windowTitle(self, windowId):
+        window = self.window(windowId)
+        try:
+            prop = window.get_full_property(self.NET_WM_NAME, X.AnyPropertyType)
+            if prop is not None:
+                title = prop.value
+            else:
+                title = window.get_wm_name()
+        except Exception:
+            return ""
+        if isinstance(title, bytes):
+            title = title.decode("utf-8", "replace")
+        return title or ""
+        
+    def listWindows(self):
+        prop = self.root.get_full_property(self.NET_CLIENT_LIST, X.AnyPropertyType)
+        winlist = []
+        for windowId in (prop.value if prop is not None else []):
+            title = self.windowTitle(windowId)
+            if title != "":
+                trace("Found window %s - %s " % (windowId, title), 3)
+            winlist.append( (windowId, title) )
+        return winlist
+        
+    def activeWindow(self):
+        prop = self.root.get_full_property(self.NET_ACTIVE_WINDOW, X.AnyPropertyType)
+        if prop is None or len(prop.value) == 0 or prop.value[0] == 0:
+            return None
+        return prop.value[0]
+        
+    def isWindow(self, windowId):
+        prop = self.root.get_full_property(self.NET_CLIENT_LIST, X.AnyPropertyType)
+        return prop is not None and windowId in prop.value
+        
+    def captureWindow(self, windowId):
+        window = self.window(windowId)
+        geometry = window.get_geometry()
+        origin = self.root.translate_coords(window, 0, 0)
+        shot = self.screen.grab({"left": origin.x, "top": origin.y, "width": geometry.width, "height": geometry.height})
+        frame = numpy.frombuffer(shot.raw, dtype=numpy.uint8).reshape(shot.height, shot.width, 4)
+        return frame[:, :, 2::-1]
+        
+    def close(self):
+        self.screen.close()
+        self.display.close()
@@ -0,0 +1,154 @@
+from datetime import datetime
+from collections import deque
+
+from util import trace, settings
+from event_loop import getEventLoop
+
+class VariationRequestsHandler:
+    """ Limits the number of variations each user can post, the counts are reset every few minutes """
+    def __init__(self):
+        self.users = {}
+        self.nPostsMax = int(settings["allowed_variations_per_user"])
+        self.resetTimer = int(settings["reset_variation_count_timer"])
+        self.lastResetTime = datetime.now()
+
+    def canUserPost(self, user):
+        try:
+            posts = self.users[user]
+            return posts < self.nPostsMax
+        except KeyError:
+            return True
+
+    def resetUserCount(self):
+        self.users = {}
+
+    def update(self):
+        timelapse = (datetime.now() - self.lastResetTime).total_seconds()
+        if timelapse > self.resetTimer * 60:
+            self.resetUserCount()
+            self.lastResetTime = datetime.now()
+
+    def addPost(self, user):
+        """ Counts a post from the user, gives False if the user can't post anymore """
+        self.update()
+        if not self.canUserPost(user):
+            return False
+        if user in self.users.keys():
+            self.users[user] += 1
+        else:
+            self.users[user] = 1
+        return True
+
+class DisplayEntry:
+    """ A variation waiting to be displayed, with what each output needs to display it """
+    def __init__(self, user, moves, colors, variationIndex=None, overlayImage=None):
+        self.user = user
+        self.moves = moves
+        self.colors = colors
+        self.variationIndex = variationIndex
+        self.overlayImage = overlayImage
+        self.displayTime = 0
+
+class DisplayScheduler:
+    """ Single timeline of the variations displayed on every output : Sabaki, the overlay image and the overlay browser source.
+        Outputs have showVariation(entry) and clearVariation() methods, called from the event loop when a variation begins and ends.
+        Variations are added from the event loop, where the chat is read. Every other method is also called from the event loop,
+        other threads go through skip, extend and clear which forward to it. """
+
+    def __init__(self):
+        self.outputs = []
+        self.requests = VariationRequestsHandler()
+        self.queue = deque([])
+        self.current = None
+        self.timeout = None
+        self.deadline = None
+        self.ioloop = None
+        self.baseVariationTime = int(settings["base_variation_displaying_time"])
+        self.variationTimePerStone = int(settings["variation_displaying_time_per_stone"])
+
+    def addOutput(self, output):
+        self.outputs.append(output)
+
+    def variationTime(self, nMoves):
+        return self.baseVariationTime + nMoves * self.variationTimePerStone
+
+    def call(self, method, *args):
+        if self.ioloop is None:
+            self.ioloop = getEventLoop()
+        self.ioloop.add_callback(method, *args)
+
+    def skip(self):
+        """ Ends the current variation right away """
+        self.call(self._skip)
+
+    def extend(self, seconds):
+        """ Keeps the current variation on screen a bit longer """
+        self.call(self._extend, seconds)
+
+    def clear(self):
+        """ Ends the current variation and drops the ones waiting """
+        self.call(self._clear)
+
+    def acceptVariation(self, entry):
+        """ Gives whether a variation can be queued : it isn't already waiting, and its user hasn't reached the limit, which it counts against.
+            Called from the event loop, before anything is done for the variation. """
+        if entry.variationIndex is not None:
+            waiting = [queued for queued in self.queue if queued.variationIndex == entry.variationIndex]
+            if len(waiting) > 0 or (self.current is not None and self.current.variationIndex == entry.variationIndex):
+                trace("Variation %d is already waiting to be displayed" % entry.variationIndex, 1)
+                return False
+        if not self.requests.addPost(entry.user):
+            trace("%s can't post more variations for now" % entry.user, 1)
+            return False
+        return True
+
+    def addVariation(self, entry, nMoves):
+        """ Queues an accepted variation to display for a time depending on its number of moves, from the event loop """
+        if self.ioloop is None:
+            self.ioloop = getEventLoop()
+        entry.displayTime = self.variationTime(nMoves)
+        self.queue.append(entry)
+        if self.current is None:
+            self.nextVariation()
+
+    def _skip(self):
+        if self.current is not None:
+            trace("Skipping on-screen variation", 1)
+            self.nextVariation()
+
+    def _extend(self, seconds):
+        if self.current is not None:
+            trace("Extending on-screen variation by %d seconds" % seconds, 1)
+            self.ioloop.remove_timeout(self.timeout)
+            self.deadline += seconds
+            self.timeout = self.ioloop.call_at(self.deadline, self.nextVariation)
+
+    def _clear(self):
+        trace("Clearing queued variations", 1)
+        self.queue.clear()
+        if self.current is not None:
+            self.nextVariation()
+
+    def notifyOutputs(self, method, *args):
+        """ Calls a method on every output, an output failing doesn't keep the others from being updated """
+        for output in self.outputs:
+            try:
+                getattr(output, method)(*args)
+            except Exception as e:
+                trace("%s failed on %s : %s" % (method, output.__class__.__name__, e), 0)
+
+    def nextVariation(self):
+        """ Ends the current variation, and shows the next one or clears the outputs """
+        if self.timeout is not None:
+            self.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
+        if len(self.queue) == 0:
+            self.current = None
+            self.notifyOutputs("clearVariation")
+            return
+        self.current = self.queue.popleft()
+        self.deadline = self.ioloop.time() + self.current.displayTime
+        self.timeout = self.ioloop.call_at(self.deadline, self.nextVariation)
+        self.notifyOutputs("showVariation", self.current)
+
+displayScheduler = DisplayScheduler()
@@ -0,0 +1,65 @@
+from threading import Thread, Event
+
+import tornado.ioloop
+
+from util import trace
+
+class EventLoopThread(Thread):
+    """ Runs the tornado IOLoop shared by the twitch chat client and the websocket server for Sabaki """
+
+    def __init__(self):
+        super(EventLoopThread, self).__init__()
+        self.daemon = True
+        self.ioloop = None
+        self.ready = Event()
+
+    def run(self):
+        trace("Event loop start", 1)
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.ioloop.make_current()
+        self.ready.set()
+        self.ioloop.start()
+        trace("Event loop end", 1)
+
+    def call(self, func, *args):
+        """ Runs a function on the loop and waits for its result, for setup code that has to run on the loop such as opening servers """
+        if self.isLoopThread():
+            return func(*args)
+        done = Event()
+        result = {}
+        def callback():
+            try:
+                result["value"] = func(*args)
+            except Exception as e:
+                result["error"] = e
+            done.set()
+        self.ioloop.add_callback(callback)
+        done.wait()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+    def isLoopThread(self):
+        return tornado.ioloop.IOLoop.current(instance=False) is self.ioloop
+
+    def stop(self):
+        self.ioloop.add_callback(self.ioloop.stop)
+
+eventLoopThread = None
+
+def getEventLoop():
+    """ Gives the shared IOLoop, starting its thread on first use """
+    global eventLoopThread
+    if eventLoopThread is None:
+        eventLoopThread = EventLoopThread()
+        eventLoopThread.start()
+        eventLoopThread.ready.wait()
+    return eventLoopThread.ioloop
+
+def callInEventLoop(func, *args):
+    getEventLoop()
+    return eventLoopThread.call(func, *args)
+
+def stopEventLoop():
+    if eventLoopThread is not None:
+        eventLoopThread.stop()
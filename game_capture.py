@@ -1,159 +1,244 @@
-from ctypes import windll
 import time
 import os
+import zlib
 from threading import Thread
 
-import win32gui
-import win32ui
-import pyscreenshot as ImageGrab
-import PIL
+import PIL, PIL.Image
+import numpy
 
+from capture_sources import getCaptureSource
 from go_game import Game, COLOR_WHITE, COLOR_BLACK
 from sabaki_com import comInstance as sabakiCom
 from util import trace, settings
 
-def replacePixel(img, xy):
-    (r, g, b) = img.getpixel(xy)
-    if b < 70:
-        img.putpixel(xy, (0, 0, 0) )
-        return COLOR_BLACK
-    elif b > 145:
-        img.putpixel(xy, (255, 255, 255) )
-        return COLOR_WHITE
-    else:
-        img.putpixel(xy, (128, 128, 128) )
-        return 0
+DEFAULT_BLACK_THRESHOLD = 70
+DEFAULT_WHITE_THRESHOLD = 145
+
+def classifyStones(rgb, blackThreshold=DEFAULT_BLACK_THRESHOLD, whiteThreshold=DEFAULT_WHITE_THRESHOLD):
+    """ Gives the color of the stone under every pixel of an (..., 3) RGB array in one pass, using the blue channel """
+    blue = rgb[..., 2]
+    colors = numpy.zeros(blue.shape, dtype=numpy.int8)
+    colors[blue < blackThreshold] = COLOR_BLACK
+    colors[blue > whiteThreshold] = COLOR_WHITE
+    return colors
+
+class IntersectionSampler:
+    """ Reads a small ring of pixels around the center of each intersection, which stays clear of move numbers and last move markers,
+        and classifies each intersection by majority vote along with the fraction of the samples that agree with it. """
+    
+    def __init__(self, radius, nSamples):
+        self.radius = radius
+        self.nSamples = nSamples
+        self.shape = None
+        self.rows = None
+        self.cols = None
+        
+    def computeSamplePoints(self, shape):
+        """ Precomputes the pixel coordinates of the samples for a board region of the given size """
+        h, w = shape
+        cellH = h / 19.0
+        cellW = w / 19.0
+        # Offset by half a step, so that no sample sits on the grid lines crossing the intersection
+        angles = (numpy.arange(self.nSamples) + 0.5) * (2 * numpy.pi / self.nSamples)
+        centersY = (numpy.arange(19) + 0.5) * cellH
+        centersX = (numpy.arange(19) + 0.5) * cellW
+        rows = centersY[:, None, None] + numpy.sin(angles)[None, None, :] * self.radius * cellH
+        cols = centersX[None, :, None] + numpy.cos(angles)[None, None, :] * self.radius * cellW
+        self.rows = numpy.clip(rows, 0, h - 1).astype(numpy.intp)
+        self.cols = numpy.clip(cols, 0, w - 1).astype(numpy.intp)
+        self.shape = shape
+        trace("Computed sample points for a %dx%d board" % (w, h), 2)
+        
+    def sample(self, region):
+        """ Gathers the sample pixels of an (rows, columns, 3) board region into a (19, 19, nSamples, 3) array """
+        if region.shape[:2] != self.shape:
+            self.computeSamplePoints(region.shape[:2])
+        return region[self.rows, self.cols]
+        
+    def classify(self, samples, blackThreshold, whiteThreshold):
+        """ Gives the board color matrix and the confidence of each color, both indexed [column][row] """
+        votes = classifyStones(samples, blackThreshold, whiteThreshold)
+        nBlack = numpy.count_nonzero(votes == COLOR_BLACK, axis=2)
+        nWhite = numpy.count_nonzero(votes == COLOR_WHITE, axis=2)
+        counts = numpy.stack( (self.nSamples - nBlack - nWhite, nBlack, nWhite), axis=2 )
+        winner = counts.argmax(axis=2)
+        colors = numpy.array( (0, COLOR_BLACK, COLOR_WHITE), dtype=numpy.int8 )[winner]
+        confidence = counts.max(axis=2) / float(self.nSamples)
+        return colors.T, confidence.T
+
+def classificationImage(board):
+    """ Debugging image showing how each intersection was classified """
+    pixels = numpy.full( (19, 19), 128, dtype=numpy.uint8 )
+    pixels[board == COLOR_BLACK] = 0
+    pixels[board == COLOR_WHITE] = 255
+    return PIL.Image.fromarray(numpy.ascontiguousarray(pixels.T), "L")
+
+class CaptureDebouncer:
+    """ Temporal filter between the capture and the game : a new position is only committed once it has been read identically on several consecutive frames """
+    
+    def __init__(self, nFrames):
+        self.nFrames = nFrames
+        self.candidate = None
+        self.count = 0
+        
+    @property
+    def pending(self):
+        """ True while a new position has been seen but not confirmed yet """
+        return self.candidate is not None and self.count < self.nFrames
+        
+    def filter(self, board, committed):
+        """ Gives the position to commit to the game, or None if the board is unchanged or still waiting for confirmation """
+        if numpy.array_equal(board, committed):
+            self.candidate = None
+            self.count = 0
+            return None
+        if self.candidate is not None and numpy.array_equal(board, self.candidate):
+            self.count += 1
+        else:
+            trace("New position seen, waiting for %d frames to confirm it" % self.nFrames, 3)
+            self.candidate = board.copy()
+            self.count = 1
+        if self.count < self.nFrames:
+            return None
+        board = self.candidate
+        self.candidate = None
+        self.count = 0
+        return board
+
+# Outcomes of a capture, used to adapt the capture rate
+CAPTURE_NO_WINDOW = 0
+CAPTURE_IDLE = 1
+CAPTURE_CHANGED = 2
+
+class CaptureScheduler:
+    """ Adaptive delay between captures : back to the fastest rate as soon as the board changes,
+        then backing off exponentially while the board stays idle or no server window is in the foreground. """
+    
+    def __init__(self, minInterval, maxInterval, backoff):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.interval = minInterval
+        
+    def update(self, outcome):
+        """ Gives the delay before the next capture """
+        previous = self.interval
+        if outcome == CAPTURE_CHANGED:
+            self.interval = self.minInterval
+        else:
+            self.interval = min(self.interval * self.backoff, self.maxInterval)
+        if self.interval != previous:
+            trace("Capture rate %.2f per second" % self.rate(), 2)
+        return self.interval
+        
+    def rate(self):
+        return 1.0 / self.interval
 
 class ScreenshotDaemon(Thread):
 
-    def __init__(self, game, twitchBot):
+    def __init__(self, game, twitchBot, source=None, sendToSabaki=True):
         super(ScreenshotDaemon, self).__init__()
         self.active = False
         self.game = game
         self.twitchBot = twitchBot
+        self.source = source if source is not None else getCaptureSource()
+        self.sendToSabaki = sendToSabaki
         self.nMoves = 0
         self.servers = {}
+        for serv in settings["servers"]:
+            self.servers[serv["name"]] = {"cropleft": serv["crop_left"], "cropright": serv["crop_right"], "croptop": serv["crop_top"], "cropbottom": serv["crop_bottom"], \
+                                          "blackthreshold": serv.get("black_threshold", DEFAULT_BLACK_THRESHOLD), "whitethreshold": serv.get("white_threshold", DEFAULT_WHITE_THRESHOLD), }
         self.debugCapture = settings["setup_capture"]
-        self.timeBetweenCaptures = settings["time_between_captures"]
+        self.scheduler = CaptureScheduler(settings["capture_min_interval"], settings["capture_max_interval"], settings["capture_backoff"])
+        self.lastFingerprint = None
+        self.sampler = IntersectionSampler(settings["capture_sample_radius"], settings["capture_samples"])
+        self.minConfidence = settings["capture_min_confidence"]
+        self.debouncer = CaptureDebouncer(settings["capture_stable_frames"])
+        self.confirmInterval = settings["capture_confirm_interval"]
+        self.lastBoard = None
         
     def findLaunchedApps(self):
-    
-        # ----- Get the go apps handles -----
-        toplist, winlist = [], []
-        def enum_cb(hwnd, results):
-            title = win32gui.GetWindowText(hwnd)
-            if title != "":
-                trace("Found window %s - %s " % (hwnd, title), 3)
-            winlist.append((hwnd, win32gui.GetWindowText(hwnd)))
-        win32gui.EnumWindows(enum_cb, toplist)
-
-        self.servers = {}
-
-        for serv in settings["servers"]:
-            pattern = serv["pattern"]
-            try:
-                server = [(hwnd, title) for hwnd, title in winlist if pattern in title.lower()] [0] # Grab the first matching window handle
-                self.servers[serv["name"]] = {"hwnd": server[0], "windowname": server[1], "cropleft": serv["crop_left"], "cropright": serv["crop_right"], "croptop": serv["crop_top"], "cropbottom": serv["crop_bottom"], }
-            except Exception:
-                trace("Couldn't find a window handle for server " + serv["name"], 2)
-
-        trace("\n#####\nServers found:\n%s\n#####\n" % str(self.servers.keys()), 1)
+        self.source.findWindows()
         
     def takeScreenshot(self):
         # ----- Capture the corresponding part of the screen -----
+        capture = self.source.grab()
+        if capture is None:
+            return CAPTURE_NO_WINDOW
+        name, window, frame = capture
+        serv = self.servers[name]
         
-        hwnd = win32gui.GetForegroundWindow()
-        # hwnd = servers["Crazystone"]["hwnd"] # For debugging
+        h, w = frame.shape[:2]
+        l = int(w * serv["cropleft"] / 100.0)
+        r = int(w * (1 - serv["cropright"] / 100.0))
+        t = int(h * serv["croptop"] / 100.0)
+        b = int(h * (1 - serv["cropbottom"] / 100.0))
+        trace("Capture coordinates : %d %d %d %d" % (l,t,r,b), 2)
         
-        for name, serv in self.servers.iteritems():
-            if serv["hwnd"] == hwnd:
-                left, top, right, bot = win32gui.GetClientRect(hwnd)
-                w = right - left
-                h = bot - top
-                
-                hwndDC = win32gui.GetWindowDC(hwnd)
-                mfcDC  = win32ui.CreateDCFromHandle(hwndDC)
-                saveDC = mfcDC.CreateCompatibleDC()
-                
-                saveBitMap = win32ui.CreateBitmap()
-                saveBitMap.CreateCompatibleBitmap(mfcDC, w, h)
-
-                saveDC.SelectObject(saveBitMap)
-                
-                result = windll.user32.PrintWindow(hwnd, saveDC.GetSafeHdc(), 1)
-                
-                bmpinfo = saveBitMap.GetInfo()
-                bmpstr = saveBitMap.GetBitmapBits(True)
-                
-                # FIXME find a way to make this work since it should be faster ?
-                # bmpstr2 = ""
-                # capBegin = (int(t)-top) * bmpinfo["bmWidth"]
-                # capW = int(r) - int(l)
-                # capH = int(b) - int(t)
-                # begin = capBegin
-                # for i in range(capH):
-                    # begin += bmpinfo["bmWidth"]
-                    # end = begin + capW
-                    # bmpstr2 += bmpstr[begin:end]
-                # print "%d - %d" % (capW * capH, len(bmpstr2))
-                # img = PIL.Image.frombytes("RGB", (capW, capH), bmpstr2, "raw", "BGRX", 0, 1)
-                # ioStr = StringIO.StringIO(bmpstr2)
-                # img = PIL.Image.open(ioStr)
-                w = bmpinfo["bmWidth"]
-                h = bmpinfo["bmHeight"]
-                img = PIL.Image.frombytes("RGB", (w, h), bmpstr, "raw", "BGRX", 0, 1)
-                
-                l = w * serv["cropleft"] / 100.0
-                r = w * (1 - serv["cropright"] / 100.0)
-                t = h * serv["croptop"] / 100.0
-                b = h * (1 - serv["cropbottom"] / 100.0)
-                trace("Capture coordinates : %d %d %d %d" % (l,t,r,b), 2)
-                
-                img = img.crop( (l, t, r, b) )
-                
-                if self.debugCapture:
-                    img.show()
-                
-                win32gui.DeleteObject(saveBitMap.GetHandle())
-                saveDC.DeleteDC()
-                mfcDC.DeleteDC()
-                win32gui.ReleaseDC(hwnd, hwndDC)
-                
-                img = img.resize((19, 19), PIL.Image.BOX)
-                
-                board = []
+        if self.twitchBot is not None:
+            self.twitchBot.setCurrentServer(name)
+        
+        # Only the board rectangle is ever read from the frame, the rest of the window is never copied
+        region = frame[t:b, l:r]
+        samples = self.sampler.sample(region)
+        
+        # Skip the classification entirely when none of the sampled pixels changed since last capture
+        fingerprint = (window, w, h, zlib.crc32(samples.tobytes()))
+        if fingerprint == self.lastFingerprint and not self.debugCapture:
+            trace("Board unchanged since last capture", 3)
+            if not self.debouncer.pending:
+                return CAPTURE_IDLE
+            # An identical frame still counts towards confirming the pending position
+            board = self.lastBoard
+        else:
+            self.lastFingerprint = fingerprint
+            board = self.classify(samples, serv)
+            self.lastBoard = board
+            
+            if self.debugCapture:
+                PIL.Image.fromarray(numpy.ascontiguousarray(region), "RGB").show()
+                classificationImage(board).show()
+        
+        committed = self.debouncer.filter(board, self.game.board.colorArray)
+        if committed is not None:
+            self.game.updateGame(committed)
+            return CAPTURE_CHANGED
+        return CAPTURE_CHANGED if self.debouncer.pending else CAPTURE_IDLE
                 
-                for i in range(19):
-                    col = []
-                    for j in range(19):
-                        color = replacePixel(img, (i, j))
-                        col.append(color)
-                    board.append(col)
-                    
-                if self.debugCapture:
-                    img.show()
-                    
-                self.twitchBot.setCurrentServer(name)
-                self.game.updateGame(board)
-                return
+    def classify(self, samples, serv):
+        board, confidence = self.sampler.classify(samples, serv["blackthreshold"], serv["whitethreshold"])
+        
+        # Intersections that couldn't be read reliably keep their current color
+        uncertain = confidence < self.minConfidence
+        if uncertain.any():
+            trace("Uncertain intersections : %s" % str(numpy.argwhere(uncertain).tolist()), 3)
+            board[uncertain] = self.game.board.colorArray[uncertain]
+        return board
                 
     def run(self):
         trace("Game capture daemon start", 1)
         self.active = True
         self.counter = 0
+        self.findLaunchedApps()
         while self.active:
             gameMoves = self.game.state.nMoves
             if self.counter % 100 == 0:
-                trace("self moves %d - game moves %d" % (self.nMoves, gameMoves), 2)
-                self.findLaunchedApps()
-            self.takeScreenshot()
+                trace("self moves %d - game moves %d - capture rate %.2f per second" % (self.nMoves, gameMoves, self.scheduler.rate()), 2)
+            outcome = self.takeScreenshot()
+            delay = self.scheduler.update(outcome)
+            if self.source.finished:
+                break
             self.counter += 1
             if self.counter >= 1000:
                 self.counter = 0
-            time.sleep(self.timeBetweenCaptures)
+            if self.source.realtime:
+                # Look again sooner when a new position is waiting to be confirmed
+                time.sleep(min(self.confirmInterval, delay) if self.debouncer.pending else delay)
             if gameMoves != self.nMoves:
-                sabakiCom.updateGameState(self.game.getSgf())
+                if self.sendToSabaki:
+                    sabakiCom.updateGameState()
                 self.nMoves = gameMoves
+        self.source.close()
         trace("Game capture daemon end", 1)
             
     def stop(self):
@@ -161,4 +246,29 @@ class ScreenshotDaemon(Thread):
     
 def getScreenshotDaemon(gameState, twitchBot):
     daemonThread = ScreenshotDaemon(gameState, twitchBot)
-    return daemonThread
\ No newline at end of file
+    return daemonThread
+
+if __name__ == "__main__":
+    # Replays a directory of screenshots or a video through the capture pipeline, and reports the capture rate and resulting game
+    import sys
+    from capture_sources import ReplayCaptureSource
+    
+    if len(sys.argv) < 3:
+        print("Usage : python game_capture.py <frames directory or video> <server name> [repeat]")
+        sys.exit(1)
+    path, serverName = sys.argv[1], sys.argv[2]
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    source = ReplayCaptureSource(settings["servers"], path, serverName, preload=os.path.isdir(path))
+    game = Game()
+    daemon = ScreenshotDaemon(game, None, source, sendToSabaki=False)
+    nFrames = 0
+    begin = time.time()
+    for _ in range(repeat):
+        source.rewind()
+        while not source.finished:
+            daemon.takeScreenshot()
+            if not source.finished:
+                nFrames += 1
+    elapsed = time.time() - begin
+    print("%d frames in %.2f s - %.0f frames per second" % (nFrames, elapsed, nFrames / max(elapsed, 1e-9)))
+    print(game.getSgf())
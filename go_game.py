@@ -1,36 +1,135 @@
-from util import trace, coordsToStr
+from threading import RLock
+
+import numpy
+
+from util import trace, coordsToStr, settings
 
 # ----- Go game logic -----
 
 COLOR_BLACK = 1
 COLOR_WHITE = -1
 
+BOARD_SIZE = 19
+N_POINTS = BOARD_SIZE * BOARD_SIZE
+
 def otherColor(color):
     return color * -1
 
+def posToIndex(pos):
+    return pos[0] * BOARD_SIZE + pos[1]
+
+def indexToPos(index):
+    return divmod(index, BOARD_SIZE)
+
+def _buildNeighborTable():
+    """ Precompute the flat indices of the points adjacent to each point of the board """
+    table = []
+    for x in range(BOARD_SIZE):
+        for y in range(BOARD_SIZE):
+            adjacent = []
+            if x > 0: adjacent.append( posToIndex((x-1, y)) )
+            if x < BOARD_SIZE - 1: adjacent.append( posToIndex((x+1, y)) )
+            if y > 0: adjacent.append( posToIndex((x, y-1)) )
+            if y < BOARD_SIZE - 1: adjacent.append( posToIndex((x, y+1)) )
+            table.append(tuple(adjacent))
+    return tuple(table)
+
+NEIGHBORS = _buildNeighborTable()
+
+def boardToStr(board):
+    s = "   "
+    for x in range(19):
+        s+= chr(x+65) + " "
+    s += "\n"
+    for y in range(19):
+        s+= str(y+1) + " "
+        if y < 9:
+            s += " "
+        for x in range(19):
+            if board[x, y] == COLOR_BLACK: s+= "+ "
+            elif board[x, y] == COLOR_WHITE: s+= "- "
+            else: s+= "  "
+        s += "\n"
+    return s
+
 class Node:
     def __init__(self, color, data, moveNumber, markup=None):
         if color == COLOR_BLACK:
             self.type = "B"
         else:
             self.type = "W"
+        self.color = color
         self.data = data
         self.markup = markup
         self.prev = None
         self.children = []
         self.moveNumber = moveNumber
+        self.onMainLine = False
+        self.stringCache = None
+        # Variations starting from this node, indexed by their first move, so that identical variations share their nodes
+        self.branches = {}
+        # Memoized sgf of the branch leading to this node, only kept on variation nodes and on the main line nodes they start from
+        self.prefixCache = None
+        # Serialization caches, only used on nodes that begin a sequence : the root of the tree and the first node of each branch
+        self.treeCache = None
+        self.chainCache = None
+        self.chainEnd = None
+        # First node of the sequence this node belongs to
+        self.head = self
         
     def toString(self):
-        if self.markup is None:
-            return "%s[%s]" % (self.type, self.data)
-        else:
-            return "%s[%s]LB[%s]" % (self.type, self.data, self.markup)
+        if self.stringCache is None:
+            if self.markup is None:
+                self.stringCache = "%s[%s]" % (self.type, self.data)
+            else:
+                self.stringCache = "%s[%s]LB[%s]" % (self.type, self.data, self.markup)
+        return self.stringCache
+        
+    def toProperties(self):
+        """ Gives the node's properties in the form used by Sabaki's game trees """
+        properties = {self.type: [self.data]}
+        if self.markup is not None:
+            properties["LB"] = self.markup.split("][")
+        return properties
+        
+    def isSequenceStart(self):
+        return self.head is self
         
     def addChild(self, child):
         self.children.append(child)
         child.prev = self
+        if len(self.children) == 1:
+            # The child continues the sequence going through this node
+            child.setHead(self.head)
+        else:
+            child.setHead(child)
+            if len(self.children) == 2:
+                # The sequence going through this node now ends here and has to be serialized again, what followed begins a sequence of its own
+                self.head.chainCache = None
+                self.head.chainEnd = None
+                self.children[0].setHead(self.children[0])
+        self.invalidate()
         return child
         
+    def setHead(self, head):
+        """ Moves this node and the ones following it in its sequence to the sequence beginning at head """
+        self.treeCache = None
+        self.chainCache = None
+        self.chainEnd = None
+        node = self
+        while True:
+            node.head = head
+            if len(node.children) != 1:
+                break
+            node = node.children[0]
+        
+    def invalidate(self):
+        """ Marks the cached serializations of the sequences leading to this node as outdated, one step per branching above it """
+        node = self.head
+        while node is not None and node.treeCache is not None:
+            node.treeCache = None
+            node = node.prev.head if node.prev is not None else None
+        
     def sgfToNode(self):
         """ Gives an sgf representation of the entire branch up to this node, minus the header """
         node = self
@@ -42,122 +141,179 @@ class Node:
         return ";" + ";".join(nodes)
         
     def sgfTree(self):
-        """ Gives an sgf representation of the entire tree starting from this node """
-        sgfString = ""
-        toParse = [self]
-        level = 0
-        while len(toParse) > 0:
-            cur = toParse.pop()
-            sgfString.append(";" + toParse.toString)
-            if len(cur.children) > 1:
-                sgfString.append("(")
-                level += 1
-            elif len(cur.children) == 0:
-                sgfString += ")"
-                level -= 1
-            toParse += reversed(cur.children)
-        for _ in range(level):
-            sgfString += ")"
-        return sgfString
+        """ Gives an sgf representation of the entire tree starting from this node, with variations as branches.
+            Only the sequences that changed since last call are serialized again, and a sequence that grew is only extended. """
+        if self.treeCache is not None:
+            return self.treeCache
+        if self.chainEnd is None:
+            self.chainCache = ";" + self.toString()
+            self.chainEnd = self
+        node = self.chainEnd
+        parts = [self.chainCache]
+        while len(node.children) == 1:
+            node = node.children[0]
+            parts.append(";" + node.toString())
+        if len(parts) > 1:
+            self.chainCache = "".join(parts)
+            self.chainEnd = node
+        branches = ["(" + child.sgfTree() + ")" for child in node.children]
+        self.treeCache = self.chainCache + "".join(branches)
+        return self.treeCache
     
 class SgfMaker:
-    """ Helper class to maintain sgf representation of the game. """
+    """ Helper class to maintain sgf representation of the game.
+        Moves are added from the capture thread while variations are added and serialized from the event loop,
+        so everything touching the tree or its cached strings holds the lock. """
 
 
     def __init__(self, size=19, initialPosition=[]):
         self.header = "(;FF[4]GM[1]SZ[%d]" % size
         # self.level = 1
         self.initPos = initialPosition
+        self.initSgf = None
         self.root = None
         self.current = None
-        self.makeSgf()
+        self.mainLine = []
+        self.mainLineNodes = []
+        self.mainLineEnds = []
+        self.mainLineLength = 0
+        self.sgfString = None
         self.nMoves = len(initialPosition)
         self.pendingVariations = []
+        self.setupNode = None
+        self.lock = RLock()
         
     def addMove(self, pos, color):
-        # Add a new node after the current active one
-        posStr = coordsToStr(pos)
-        newNode = Node(color, posStr, self.nMoves + 1)
-        if self.current is None:
-            self.current = self.root = newNode
-        else:
-            self.current = self.current.addChild(newNode)
-        self.nMoves += 1
-        
-        # Update the string representation
-        self.sgfString += ";" + self.current.toString()
-        
-        # Add any pending variation
-        for pending in self.pendingVariations:
-            pending[1].addChild(pending[0])
+        with self.lock:
+            # Add a new node after the current active one
+            posStr = coordsToStr(pos)
+            newNode = Node(color, posStr, self.nMoves + 1)
+            newNode.onMainLine = True
+            if self.current is None:
+                self.current = self.root = newNode
+            else:
+                self.current = self.current.addChild(newNode)
+            self.nMoves += 1
+            
+            # Update the string representation
+            self.mainLine.append(";" + self.current.toString())
+            self.mainLineNodes.append(self.current)
+            self.mainLineLength += len(self.mainLine[-1])
+            self.mainLineEnds.append(self.mainLineLength)
+            self.sgfString = None
+            
+            # Add any pending variation
+            for pending in self.pendingVariations:
+                pending[1].addChild(pending[0])
+            self.pendingVariations = []
         
     def findNode(self, moveNumber):
-        """ Find the node corresponding to the given move number in the current branch. """
-        current = self.current
-        while current.moveNumber > moveNumber:
-            current = current.prev
-        return current
+        """ Find the main line node corresponding to the given move number, or None if it is part of the initial position or no move was played yet. """
+        index = moveNumber - len(self.initPos) - 1
+        if index < 0 or len(self.mainLineNodes) == 0:
+            return None
+        return self.mainLineNodes[min(index, len(self.mainLineNodes) - 1)]
         
     def addVariation(self, moves, fromMoveNumber):
         """ Adds a variation to the current branch at the given move number. """
-        # Find the move from which the variation begins
-        pending = False
-        if fromMoveNumber >= self.nMoves:
-            variationRoot = self.current
-            pending = True
-        else:
-            variationRoot = self.findNode(fromMoveNumber)
-        if variationRoot is None:
-            # Supposedly because the board wasn't played one move at a time but was setup all at once
-            variationRoot = Node(0, "dummy node", fromMoveNumber)
-            variationRoot.type = "C"
-            if self.root is None:
-                self.root = self.current = variationRoot
-            else: #FIXME what is this for ?
-                variationRoot.addChild(self.root)
-                self.root = variationRoot
-            
-        variationNode = self.addVariationFromNode(moves, variationRoot, pending)
-        return variationNode
+        with self.lock:
+            # Find the move from which the variation begins
+            pending = False
+            if fromMoveNumber >= self.nMoves:
+                variationRoot = self.current
+                pending = True
+            else:
+                variationRoot = self.findNode(fromMoveNumber)
+            if variationRoot is None:
+                # Supposedly because the board wasn't played one move at a time but was setup all at once
+                if self.setupNode is None:
+                    self.setupNode = Node(0, "dummy node", len(self.initPos))
+                    self.setupNode.type = "C"
+                    if self.root is None:
+                        self.root = self.current = self.setupNode
+                    else: # The moves played so far follow the setup
+                        self.setupNode.addChild(self.root)
+                        self.root = self.setupNode
+                variationRoot = self.setupNode
+                pending = False
+                
+            variationNode = self.addVariationFromNode(moves, variationRoot, pending)
+            return variationNode
         
     def addVariationFromNode(self, moves, fromNode, pending=False):
-        """ Adds a variation from the given node. """
-        # Make a branch for the variation
-        move = moves[0]
-        coords = coordsToStr(move[0])
-        variationBegin = Node(move[1], coords, fromNode.moveNumber + 1, "1")
-        current = variationBegin
-        markup = ["%s:%d" % (coords, 1)]
-        for i in range(1, len(moves)):
-            move = moves[i]
-            coords =  coordsToStr(move[0])
-            markup.append("%s:%d" % (coords, i+1))
-            markupString = "][".join(markup)
-            current = current.addChild( Node(move[1], coords, fromNode.moveNumber + 1 + i, markupString) )
-        
-        if pending:
-            variationBegin.prev = fromNode # Don't link it to the sgf right away because it might cause issues when updating the live game
-            self.pendingVariations.append( (variationBegin, fromNode) )
-        else:
-            fromNode.addChild(variationBegin)
-        return current
+        """ Adds a variation from the given node. The moves already posted from there are shared instead of being added again. """
+        with self.lock:
+            current = fromNode
+            # Moves added to an earlier variation keep being numbered after it
+            markup = [] if fromNode.onMainLine or fromNode.markup is None else fromNode.markup.split("][")
+            offset = len(markup)
+            for i in range(len(moves)):
+                move = moves[i]
+                coords = coordsToStr(move[0])
+                markup.append("%s:%d" % (coords, offset + i + 1))
+                node = Node(move[1], coords, fromNode.moveNumber + 1 + i, "][".join(markup))
+                key = (node.type, coords)
+                try:
+                    current = current.branches[key]
+                except KeyError:
+                    current.branches[key] = node
+                    if current is fromNode and pending:
+                        node.prev = fromNode # Don't link it to the sgf right away because it might cause issues when updating the live game
+                        self.pendingVariations.append( (node, fromNode) )
+                    else:
+                        current.addChild(node)
+                    current = node
+            return current
+        
+    def mainLinePrefix(self, node):
+        """ Gives the sgf of the main line up to the given main line node, minus the header """
+        start = len(self.header) + len(self.sgfForInitialPosition())
+        return self.getSgf()[start:start + self.mainLineEnds[node.moveNumber - len(self.initPos) - 1]]
+        
+    def sgfToNode(self, node):
+        """ Gives the sgf of the branch leading to the given node, minus the header.
+            Only the moves after the closest memoized node are serialized. """
+        with self.lock:
+            chain = []
+            while node.prefixCache is None and not node.onMainLine and node.prev is not None:
+                chain.append(node)
+                node = node.prev
+            if node.prefixCache is None:
+                if node.onMainLine:
+                    node.prefixCache = self.mainLinePrefix(node)
+                else:
+                    node.prefixCache = node.sgfToNode()
+            prefix = node.prefixCache
+            for node in reversed(chain):
+                prefix = node.prefixCache = prefix + ";" + node.toString()
+            return prefix
         
     def sgfForInitialPosition(self):
-        sgfString = ""
-        for move in self.initPos:
-            pos, color = move
-            if color == COLOR_BLACK:
-                sgfString += ";AB[%s]" % coordsToStr(pos)
-            else:
-                sgfString += ";AW[%s]" % coordsToStr(pos)
-        return sgfString
+        if self.initSgf is None:
+            nodes = []
+            for move in self.initPos:
+                pos, color = move
+                if color == COLOR_BLACK:
+                    nodes.append(";AB[%s]" % coordsToStr(pos))
+                else:
+                    nodes.append(";AW[%s]" % coordsToStr(pos))
+            self.initSgf = "".join(nodes)
+        return self.initSgf
+        
+    def getSgf(self):
+        """ Gives the sgf for the main line of the game """
+        with self.lock:
+            if self.sgfString is None:
+                self.sgfString = self.header + self.sgfForInitialPosition() + "".join(self.mainLine) + ")"
+            return self.sgfString
     
     def makeSgf(self):
-        """ Creates the sgf for the complete tree """
-        self.sgfString = self.header + self.sgfForInitialPosition()
-        
-        if self.root is not None:
-            self.sgfString += self.root.sgfTree()
+        """ Creates the sgf for the complete tree, variations included """
+        with self.lock:
+            sgfString = self.header + self.sgfForInitialPosition()
+            if self.root is not None:
+                sgfString += self.root.sgfTree()
+            return sgfString + ")"
         
 class Group:
     """ Describe the state of a group of connected stones within a Go game """
@@ -292,32 +448,228 @@ class Board:
                 enemies.add(group)
         return (friends, enemies, libs)
     
+    @property
+    def colorArray(self):
+        return numpy.array([[self[x, y] for y in range(19)] for x in range(19)], dtype=numpy.int8)
+        
+    def diff(self, capture):
+        """ Gives the list of (pos, color) for every point where the capture differs from the board """
+        changes = []
+        for i in range(19):
+            for j in range(19):
+                color = capture[i][j]
+                if color != self[i, j]:
+                    changes.append( ((i, j), color) )
+        return changes
+    
     def toStr(self):
-        s = "   "
-        for x in range(19):
-            s+= chr(x+65) + " "
-        s += "\n"
-        for y in range(19):
-            s+= str(y+1) + " "
-            if y < 9:
-                s += " "
-            for x in range(19):
-                if self[x, y] == COLOR_BLACK: s+= "+ "
-                elif self[x, y] == COLOR_WHITE: s+= "- "
-                else: s+= "  "
-            s += "\n"
-        return s
+        return boardToStr(self)
+    
+class FlatGroup:
+    """ Snapshot of a group of connected stones on a FlatBoard, computed on demand """
+    def __init__(self, color, stones, libs):
+        self.color = color
+        self.stones = stones
+        self.libs = libs
+        self.id = min(stones)
+        
+    def isDead(self):
+        return len(self.libs) <= 0
+        
+    @property
+    def pos(self):
+        return indexToPos(self.stones[0])
+        
+    @property
+    def moves(self):
+        return [indexToPos(index) for index in self.stones]
+        
+    @property
+    def liberties(self):
+        return set([indexToPos(index) for index in self.libs])
+        
+class FlatBoard:
+    """ Board engine backed by a flat array of colors and a precomputed neighbor table.
+        Groups are not maintained incrementally but flood-filled when needed, which makes building a board from a full position almost free.
+        The colors are mirrored in a numpy int8 array so that a capture can be compared to the board in a single operation. """
+    def __init__(self, capture=None):
+        if capture is None:
+            self.colorArray = numpy.zeros( (BOARD_SIZE, BOARD_SIZE), dtype=numpy.int8 )
+        else:
+            self.colorArray = numpy.array(capture, dtype=numpy.int8)
+        self.colors = self.colorArray.ravel().tolist()
+            
+    def __getitem__(self, pos):
+        return self.colors[pos[0] * BOARD_SIZE + pos[1]]
+        
+    def getGroupAt(self, pos):
+        index = posToIndex(pos)
+        color = self.colors[index]
+        if color == 0:
+            return None
+        stones, libs = self.floodGroup(index)
+        return FlatGroup(color, stones, libs)
+        
+    def floodGroup(self, index):
+        """ Gives the stones and liberties of the group at the given index, as flat indices """
+        colors = self.colors
+        color = colors[index]
+        stones = [index]
+        visited = set(stones)
+        libs = set([])
+        i = 0
+        while i < len(stones):
+            for adj in NEIGHBORS[stones[i]]:
+                if adj in visited:
+                    continue
+                adjColor = colors[adj]
+                if adjColor == color:
+                    visited.add(adj)
+                    stones.append(adj)
+                elif adjColor == 0:
+                    libs.add(adj)
+            i += 1
+        return stones, libs
+        
+    def hasLiberty(self, index):
+        """ Flood-fills the group at the given index, stopping as soon as a liberty is found """
+        colors = self.colors
+        color = colors[index]
+        toVisit = [index]
+        visited = set(toVisit)
+        while len(toVisit) > 0:
+            for adj in NEIGHBORS[toVisit.pop()]:
+                adjColor = colors[adj]
+                if adjColor == 0:
+                    return True
+                if adjColor == color and adj not in visited:
+                    visited.add(adj)
+                    toVisit.append(adj)
+        return False
+        
+    def copy(self):
+        board = FlatBoard.__new__(FlatBoard)
+        board.colors = self.colors[:]
+        board.colorArray = self.colorArray.copy()
+        return board
+        
+    def addStone(self, pos, color):
+        index = posToIndex(pos)
+        colors = self.colors
+        colors[index] = color
+        self.colorArray[pos] = color
+        enemy = otherColor(color)
+        for adj in NEIGHBORS[index]:
+            if colors[adj] == enemy and not self.hasLiberty(adj):
+                self.removeGroup(adj)
+                
+    def removeGroup(self, index):
+        stones, _ = self.floodGroup(index)
+        trace("Killing group %d" % min(stones), 2)
+        colors = self.colors
+        flatArray = self.colorArray.ravel()
+        for stone in stones:
+            colors[stone] = 0
+            flatArray[stone] = 0
+            
+    def diff(self, capture):
+        """ Gives the list of (pos, color) for every point where the capture differs from the board """
+        capture = numpy.asarray(capture, dtype=numpy.int8)
+        changed = numpy.flatnonzero(capture != self.colorArray)
+        if len(changed) == 0:
+            return []
+        flatCapture = capture.ravel()
+        return [(indexToPos(index), int(flatCapture[index])) for index in changed.tolist()]
+            
+    def toStr(self):
+        return boardToStr(self)
+    
+class MoveSequenceFinder:
+    """ Bounded depth-first search for a legal sequence of alternating moves that turns a board into a captured position.
+        Besides the stones that appeared on the capture, the sequence can contain a few hidden moves next to the changed points,
+        i.e. stones that were played and captured again between 2 captures, as in snapbacks. """
+    
+    def __init__(self, maxMoves, maxHiddenMoves, maxNodes):
+        self.maxMoves = maxMoves
+        self.maxHiddenMoves = maxHiddenMoves
+        self.maxNodes = maxNodes
+        self.nodes = 0
+        
+    def find(self, board, capture, firstColors):
+        """ Gives the list of (pos, color) moves leading from the board to the capture, trying each possible first color in order, or None """
+        target = numpy.asarray(capture, dtype=numpy.int8).ravel().tolist()
+        start = FlatBoard(board.colorArray)
+        changed = [index for index in range(N_POINTS) if start.colors[index] != target[index]]
+        
+        # Points that must receive a stone of each color, and empty points around the changes where a stone may have been played then captured
+        self.required = {COLOR_BLACK: [], COLOR_WHITE: []}
+        hidden = set([])
+        for index in changed:
+            if target[index] != 0:
+                self.required[target[index]].append(index)
+            for adj in NEIGHBORS[index]:
+                if start.colors[adj] == 0 and target[adj] == 0:
+                    hidden.add(adj)
+        if len(self.required[COLOR_BLACK]) + len(self.required[COLOR_WHITE]) > self.maxMoves:
+            return None
+        self.hidden = sorted(hidden)
+        self.target = target
+        self.nodes = 0
+        
+        for color in firstColors:
+            moves = self.search(start, color, [], self.maxHiddenMoves)
+            if moves is not None:
+                trace("Found a sequence of %d moves after %d tries" % (len(moves), self.nodes), 2)
+                return [(indexToPos(index), moveColor) for index, moveColor in moves]
+        trace("No sequence of moves found after %d tries" % self.nodes, 1)
+        return None
+        
+    def remaining(self, board, color):
+        colors = board.colors
+        return [index for index in self.required[color] if colors[index] != color]
+        
+    def search(self, board, color, moves, hiddenLeft):
+        if board.colors == self.target:
+            return moves
+        if self.nodes >= self.maxNodes:
+            return None
+        
+        # Each missing stone takes at least one move, and the colors alternate
+        nOwn = len(self.remaining(board, color))
+        nOther = len(self.remaining(board, otherColor(color)))
+        if len(moves) + max(2 * nOwn - 1, 2 * nOther) > self.maxMoves:
+            return None
+        
+        candidates = [index for index in self.required[color] if board.colors[index] == 0]
+        if hiddenLeft > 0:
+            candidates += [index for index in self.hidden if board.colors[index] == 0]
+        for index in candidates:
+            self.nodes += 1
+            child = board.copy()
+            child.addStone(indexToPos(index), color)
+            if not child.hasLiberty(index):
+                continue # Suicide
+            isHidden = self.target[index] != color
+            result = self.search(child, otherColor(color), moves + [(index, color)], hiddenLeft - 1 if isHidden else hiddenLeft)
+            if result is not None:
+                return result
+        return None
     
 class Game:
     """ Internal representation of the state of a game of of Go. This is the class you are supposed to interact with. """
     
-    def __init__(self, capture=None):
+    def __init__(self, capture=None, boardClass=FlatBoard):
+        self.boardClass = boardClass
+        self.generation = 0
+        self.moveFinder = MoveSequenceFinder(settings["reconstruction_max_moves"], settings["reconstruction_max_hidden_moves"], settings["reconstruction_max_nodes"])
         self.reset(capture)
         self.variations = []
+        self.variationIndices = {}
         self.nextvariationIndex = 0
         
     def reset(self, capture=None):
-        self.board = Board(capture)
+        self.generation += 1
+        self.board = self.boardClass(capture)
         if capture is None:
             self.state = SgfMaker()
             self.nextToPlay = COLOR_BLACK
@@ -336,61 +688,27 @@ class Game:
         return self.nextToPlay if self.nextToPlay != 0 else COLOR_BLACK
     
     def updateGame(self, capture):
-        newMoves = []
-        potentialCapture = False
-        for i in range(19):
-            for j in range(19):
-                color = capture[i][j]
-                if color != self.board[i, j]:
-                    if color == 0:
-                        potentialCapture = True
-                    newMoves.append( ((i, j), color) )
-        if potentialCapture:
-            groups = set([])
-            addedStones = []
-            colors = []
-            for pos, color in newMoves:
-                if color == 0:
-                    groups.add( self.board.getGroupAt(pos) )
-                else:
-                    addedStones.append(pos)
-                    colors.append(color)
-            for group in groups:
-                for lib in group.liberties:
-                    if lib not in addedStones:
-                        trace("Liberties %s were never filled" % str(group.liberties), 0)
-                        trace("Warning : couldn't find the order of moves, resetting game", 0)
-                        self.reset(capture)
-                        trace("Game reset complete", 0)
-                        return
-            newMoves = []
-            for i in range(len(addedStones)):
-                newMoves.append( (addedStones[i], colors[i]) )                
+        newMoves = self.board.diff(capture)
         if len(newMoves) == 0:
             return
-        elif len(newMoves) > 2:
-            import time; time.sleep(2)
-            trace("Warning : too many moves were played before last update, resetting game", 0)
+        
+        # Find out which moves were played since last update, trying the most likely first player first
+        if self.nextToPlay == 0:
+            firstColors = (COLOR_BLACK, COLOR_WHITE)
+        else:
+            firstColors = (self.nextToPlay, otherColor(self.nextToPlay))
+        moves = self.moveFinder.find(self.board, capture, firstColors)
+        if moves is None:
+            trace("Warning : couldn't find the order of moves, resetting game", 0)
             self.reset(capture)
             trace("Game reset complete", 0)
-        elif len(newMoves) == 1:
-            pos, color = newMoves[0]
+            return
+        
+        knowWhoPlaysNext = self.nextToPlay != 0
+        for pos, color in moves:
             self.addMove(pos, color)
-        else:
-            # FIXME check for snapback
-            knowWhoPlaysNext = True
-            if self.nextToPlay == 0:
-                knowWhoPlaysNext = False
-            firstMove = newMoves[0]
-            secondMove = newMoves[1]
-            if self.nextToPlay == secondMove[1]:
-                tmp = firstMove
-                firstMove = secondMove
-                secondMove = tmp
-            self.addMove(firstMove[0], firstMove[1])
-            self.addMove(secondMove[0], secondMove[1])
-            if not knowWhoPlaysNext:
-                self.nextToPlay = 0
+        if not knowWhoPlaysNext and len(moves) > 1:
+            self.nextToPlay = 0
     
     def addMove(self, move, color):
         self.state.addMove(move, color)
@@ -398,19 +716,106 @@ class Game:
         self.nextToPlay = otherColor(color)
     
     def addVariation(self, moves, fromMoveNumber=9999):
-        nMovesVariation = len(moves)
-        self.variations.append( (self.state.addVariation(moves, fromMoveNumber), nMovesVariation) )
-        self.nextvariationIndex += 1
-        return self.nextvariationIndex - 1
+        """ Gives the index of the new variation, or of the identical one that was already posted """
+        return self.registerVariation(self.state.addVariation(moves, fromMoveNumber), len(moves))
     
     def expandVariation(self, moves, variationIndex):
-        variationNode = self.getVariation(variationIndex)
-        self.state.addVariationFromNode(variationNode)
-        return variationIndex
+        """ Continues a previous variation with more moves, as a new variation. It stays in the game it was posted on, even if the game was reset since. """
+        variation, nMoves, state, generation = self.variations[variationIndex]
+        return self.registerVariation(state.addVariationFromNode(moves, variation), nMoves + len(moves), state, generation)
+        
+    def registerVariation(self, variation, nMoves, state=None, generation=None):
+        """ Variations keep the sgf maker and the generation of the game they were posted on """
+        if variation in self.variationIndices:
+            return self.variationIndices[variation]
+        if state is None:
+            state, generation = self.state, self.generation
+        self.variations.append( (variation, nMoves, state, generation) )
+        self.variationIndices[variation] = self.nextvariationIndex
+        self.nextvariationIndex += 1
+        return self.nextvariationIndex - 1
+        
+    def nextPlayerAfterMove(self, moveNumber):
+        """ Color to play after the given main line move """
+        node = self.state.findNode(moveNumber)
+        if node is None:
+            return COLOR_BLACK
+        return otherColor(node.color)
+        
+    def nextPlayerAfterVariation(self, variationIndex):
+        """ Color to play after the last move of the given variation """
+        return otherColor(self.variations[variationIndex][0].color)
         
     def getVariation(self, variationIndex):
-        variation, nMoves = self.variations[variationIndex]
-        return (self.state.header + self.state.sgfForInitialPosition() + variation.sgfToNode() + ")", nMoves)
+        """ Gives the full sgf of the variation, built from the game it was posted on """
+        variation, nMoves, state, generation = self.variations[variationIndex]
+        return (state.header + state.sgfForInitialPosition() + state.sgfToNode(variation) + ")", nMoves)
+    
+    def getVariationDelta(self, variationIndex):
+        """ Gives the variation as the main line move it starts from and its nodes' properties,
+            or None if it doesn't start from the main line or was posted before the game was reset """
+        variation, nMoves, state, generation = self.variations[variationIndex]
+        if generation != self.generation:
+            return None
+        nodes = []
+        node = variation
+        while node is not None and not node.onMainLine:
+            nodes.append(node.toProperties())
+            node = node.prev
+        if node is None:
+            return None
+        nodes.reverse()
+        return {"from": node.moveNumber, "nodes": nodes}
+        
+    def getMainLineNodes(self, fromMoveNumber):
+        """ Gives the properties of the main line nodes played after the given move number """
+        first = fromMoveNumber - len(self.state.initPos)
+        return [node.toProperties() for node in self.state.mainLineNodes[first:]]
     
     def getSgf(self):
-        return self.state.sgfString + ")"
+        return self.state.getSgf()
+        
+    def getSgfTree(self):
+        return self.state.makeSgf()
+
+
+if __name__ == "__main__":
+    # Benchmark the board engines on full-position rebuilds and on move-by-move play
+    import random
+    import timeit
+    
+    random.seed(0)
+    reference = Board()
+    moves = []
+    color = COLOR_BLACK
+    while len(moves) < 250:
+        pos = (random.randrange(19), random.randrange(19))
+        if reference[pos] != 0:
+            continue
+        reference.addStone(pos, color)
+        moves.append( (pos, color) )
+        color = otherColor(color)
+    capture = [[reference[x, y] for y in range(19)] for x in range(19)]
+    captureArray = numpy.array(capture, dtype=numpy.int8)
+    
+    def playMoves(boardClass):
+        board = boardClass()
+        for pos, color in moves:
+            board.addStone(pos, color)
+        return board
+    
+    for boardClass in (Board, FlatBoard):
+        played = playMoves(boardClass)
+        assert all(played[x, y] == capture[x][y] for x in range(19) for y in range(19))
+    
+    repeat = 200
+    def diffCapture(boardClass, boards={}):
+        if boardClass not in boards:
+            boards[boardClass] = boardClass(capture)
+        return boards[boardClass].diff(captureArray)
+    
+    for name, statement in (("rebuild", lambda boardClass: boardClass(capture)), ("play", playMoves), ("diff", diffCapture)):
+        timings = {}
+        for boardClass in (Board, FlatBoard):
+            timings[boardClass] = timeit.timeit(lambda: statement(boardClass), number=repeat) / repeat
+        print("%-8s Board %.3f ms - FlatBoard %.3f ms - x%.1f" % (name, timings[Board] * 1000, timings[FlatBoard] * 1000, timings[Board] / timings[FlatBoard]))
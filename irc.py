@@ -0,0 +1,167 @@
+# IRC message framing and parsing, as used by twitch chat : https://dev.twitch.tv/docs/irc
+import time
+import random
+from collections import deque
+
+from util import trace
+
+TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def unescapeTagValue(value):
+    if "\\" not in value:
+        return value
+    chars = []
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char == "\\":
+            i += 1
+            if i < len(value):
+                chars.append(TAG_ESCAPES.get(value[i], value[i]))
+        else:
+            chars.append(char)
+        i += 1
+    return "".join(chars)
+
+class IRCMessage:
+    """ A single IRC line split into its IRCv3 tags, prefix, command and parameters """
+    def __init__(self, tags, prefix, command, params):
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+    @property
+    def nick(self):
+        """ Nickname of the sender, from a nick!user@host prefix """
+        if self.prefix is None:
+            return None
+        return self.prefix.split("!", 1)[0]
+
+    @property
+    def trailing(self):
+        """ Last parameter, which holds the text of chat messages """
+        return self.params[-1] if len(self.params) > 0 else None
+
+    def __repr__(self):
+        return "IRCMessage(%s, %s, %s)" % (self.prefix, self.command, self.params)
+
+def parseIRCMessage(line):
+    """ Parses a line without its line ending : [@tags ][:prefix ]command[ params][ :trailing] """
+    tags = {}
+    if line.startswith("@"):
+        rawTags, _, line = line[1:].partition(" ")
+        for tag in rawTags.split(";"):
+            key, _, value = tag.partition("=")
+            tags[key] = unescapeTagValue(value)
+        line = line.lstrip(" ")
+    prefix = None
+    if line.startswith(":"):
+        prefix, _, line = line[1:].partition(" ")
+        line = line.lstrip(" ")
+    trailing = None
+    if " :" in line:
+        line, trailing = line.split(" :", 1)
+    elif line.startswith(":"):
+        line, trailing = "", line[1:]
+    params = line.split()
+    command = params.pop(0).upper() if len(params) > 0 else ""
+    if trailing is not None:
+        params.append(trailing)
+    return IRCMessage(tags, prefix, command, params)
+
+class IRCLineBuffer:
+    """ Accumulates the data received from the socket and frames it into complete lines, keeping partial lines for the next read.
+        Complete lines stay queued until they are consumed, so a caller that stops iterating picks the rest up on its next feed. """
+    def __init__(self):
+        self.data = b""
+        self.lines = deque([])
+
+    def feed(self, data):
+        """ Adds received data and yields the messages of the lines waiting, along with the ones it completes """
+        self.data += data
+        if b"\n" in data:
+            lines = self.data.split(b"\n")
+            self.data = lines.pop()
+            self.lines.extend(lines)
+        while len(self.lines) > 0:
+            line = self.lines.popleft().rstrip(b"\r").decode("utf-8", "replace")
+            if len(line) > 0:
+                yield parseIRCMessage(line)
+
+    def clear(self):
+        self.data = b""
+        self.lines.clear()
+
+class RateLimiter:
+    """ Sliding window limit : at most maxMessages sent over any period of the given length in seconds """
+    def __init__(self, maxMessages, period):
+        self.maxMessages = maxMessages
+        self.period = period
+        self.sent = deque([])
+
+    def expire(self):
+        limit = time.time() - self.period
+        while len(self.sent) > 0 and self.sent[0] <= limit:
+            self.sent.popleft()
+
+    def take(self):
+        self.expire()
+        if len(self.sent) >= self.maxMessages:
+            return False
+        self.sent.append(time.time())
+        return True
+
+    def delay(self):
+        """ Time in seconds before the next message can be sent """
+        self.expire()
+        if len(self.sent) < self.maxMessages:
+            return 0
+        return max(0, self.sent[0] + self.period - time.time())
+
+class SendQueue:
+    """ Chat messages waiting for the rate limit. A message can be a function building the text when it is actually sent,
+        so that messages which pile up while waiting can be merged. Must be used from the event loop. """
+    def __init__(self, write, ioloop, limiter):
+        self.write = write
+        self.ioloop = ioloop
+        self.limiter = limiter
+        self.queue = deque([])
+        self.timeout = None
+
+    def send(self, message):
+        self.queue.append(message)
+        if self.timeout is None:
+            self.flush()
+
+    def flush(self):
+        self.timeout = None
+        while len(self.queue) > 0 and self.limiter.take():
+            message = self.queue.popleft()
+            if callable(message):
+                message = message()
+            self.write(message)
+        if len(self.queue) > 0 and self.timeout is None:
+            trace("%d chat messages waiting for the rate limit" % len(self.queue), 2)
+            self.timeout = self.ioloop.call_later(self.limiter.delay(), self.flush)
+
+    def clear(self):
+        self.queue.clear()
+        if self.timeout is not None:
+            self.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
+
+class ReconnectBackoff:
+    """ Exponential delay between reconnection attempts, with random jitter so that clients cut off together don't all come back at once """
+    def __init__(self, minDelay, maxDelay):
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.attempts = 0
+
+    def nextDelay(self):
+        delay = min(self.maxDelay, self.minDelay * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(delay / 2.0, delay)
+
+    def reset(self):
+        self.attempts = 0
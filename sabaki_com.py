@@ -1,15 +1,13 @@
-from threading import Thread, Timer
-from datetime import datetime
-from collections import deque
-import time
+from threading import Lock
 
 import tornado.httpserver
 import tornado.websocket
-import tornado.ioloop
 import tornado.web
 import simplejson as json
 
 from util import trace, settings
+from event_loop import getEventLoop, callInEventLoop
+from display_scheduler import displayScheduler
 
 DUMMY_SGF = "(;FF[4]GM[1]SZ[19]AP[SGFC:1.13b] \
 \
@@ -29,123 +27,149 @@ Usually B plays the 3,3 invasion - see variation];W[qo];B[qp]\
 (;W[dq]N[wrong direction];B[qo];W[qp]))"
 
 
-class VariationRequestsHandler:
-    def __init__(self, comInstance):
-        self.comInstance = comInstance
-        self.activeVariation = None
-        self.variationQueue = deque([])
-        self.users = {}
-        self.nPostsMax = int(settings["allowed_variations_per_user"])
-        self.resetTimer = int(settings["reset_variation_count_timer"])
-        self.baseVariationTime = int(settings["base_variation_displaying_time"])
-        self.variationTimePerStone = int(settings["variation_displaying_time_per_stone"])
-        self.lastResetTime = datetime.now()
-        
-    def canUserPost(self, user):
-        try:
-            posts = self.users[user]
-            return posts < 3
-        except KeyError:
-            return True
-            
-    def resetUserCount(self):
-        self.users = {}
-        
-    def update(self):
-        timelapse = (datetime.now() - self.lastResetTime).total_seconds()
-        if timelapse > self.resetTimer * 60:
-            self.resetUserCount()
-            self.lastResetTime = datetime.now()
-        
-    def addVariation(self, variation, user, nMoves):
-        self.update()
-        if self.canUserPost(user):
-            self.variationQueue.append( (variation, self.variationTime(nMoves)) )
-            if user in self.users.keys():
-                self.users[user] += 1
-            else:
-                self.users[user] = 1
-    
-    def variationTime(self, nMoves):
-        return self.baseVariationTime + nMoves * self.variationTimePerStone
-    
-    def getVariation(self):
-        if len(self.variationQueue) == 0:
-            return None
-        return self.variationQueue.popleft()
-
-class SabakiCommunication(Thread):
+class SabakiCommunication:
+    """ Keeps Sabaki in sync with the game. The full sgf is only sent when Sabaki connects or after the game was reset,
+        otherwise only the new main line moves and the variations are sent, as deltas on Sabaki's game tree. """
     
     def __init__(self):
-        super(SabakiCommunication, self).__init__()
-        self.variationsHandler = VariationRequestsHandler(self)
-        self.gameState = None
+        self.game = None
         self.showingVariation = False
+        self.variationOnBoard = False
+        self.needsResync = True
+        self.sentGeneration = None
+        self.sentMoveNumber = 0
+        self.lock = Lock()
         self.wsHandler = None
+        self.httpServer = None
+        self.ioloop = None
         self.paused = False
         
+    def bindGame(self, game):
+        self.game = game
+        
     def bindWsHandler(self, wsHandler):
         self.wsHandler = wsHandler
-        
-    def run(self):
+        # Whatever Sabaki had before is lost, start again from the full game
+        self.needsResync = True
+        self.variationOnBoard = False
+        
+    def listen(self):
+        """ Opens the websocket server on the shared event loop """
+        self.ioloop = getEventLoop()
+        callInEventLoop(self._listen)
+        
+    def _listen(self):
+        routes = [(r'/', WSHandler), ]
+        if settings["overlay_browser_source"]:
+            from browser_overlay import overlayRoutes
+            routes += overlayRoutes()
+        application = tornado.web.Application(routes)
+        self.httpServer = tornado.httpserver.HTTPServer(application)
+        self.httpServer.listen(4257, address="localhost")
         trace("Websocket server start", 1)
-        tornado.ioloop.IOLoop.instance().start()
-        trace("Websocket server end", 1)
+        for sock in self.httpServer._sockets.values():
+            trace(sock.getsockname(), 2)
+            trace("#####", 2)
     
     def stop(self):
-        self.wsHandler.close()
-        tornado.ioloop.IOLoop.instance().stop()
+        callInEventLoop(self._stop)
+        
+    def _stop(self):
+        if self.wsHandler is not None:
+            self.wsHandler.close()
+        self.httpServer.stop()
+        trace("Websocket server end", 1)
+        
+    def send(self, message):
+        """ Sends a message to Sabaki from any thread, the websocket itself is only written from the IOLoop """
+        data = json.dumps(message, separators=(",", ":") )
+        self.ioloop.add_callback(self.wsHandler.write_message, data)
         
     def closeSabaki(self):
         trace("Sending close request to Sabaki", 1)
         try:
-            self.wsHandler.write_message(json.dumps({"action": "close"}, separators=(",", ":") ))
+            self.send({"action": "close"})
         except AttributeError:
             trace("Warning : Couldn't send a quit request to sabaki.", 0)
 
-    def sendGame(self, sgf):
+    def sendGame(self):
         trace("Sending game to sabaki", 1)
-        self.wsHandler.write_message(json.dumps({"action": "play", "data": sgf}, separators=(",", ":") ))
+        # Moves keep being added from the capture thread, the move count has to match the sgf sent
+        self.sentGeneration = self.game.generation
+        state = self.game.state
+        with state.lock:
+            sgf = state.getSgf()
+            self.sentMoveNumber = state.nMoves
+        self.send({"action": "play", "data": sgf})
+        self.needsResync = False
+        self.variationOnBoard = False
+        
+    def sendMainLine(self):
+        """ Brings Sabaki's main line up to date with the game """
+        if self.needsResync or self.sentGeneration != self.game.generation:
+            self.sendGame()
+            return
+        if self.variationOnBoard:
+            trace("Sending return to main line to sabaki", 2)
+            self.send({"action": "mainline"})
+            self.variationOnBoard = False
+        nodes = self.game.getMainLineNodes(self.sentMoveNumber)
+        if len(nodes) > 0:
+            trace("Sending %d new moves to sabaki" % len(nodes), 2)
+            self.send({"action": "append", "nodes": nodes})
+            self.sentMoveNumber += len(nodes)
 
-    def sendVariation(self, sgf):
+    def sendVariation(self, variationIndex):
         trace("Sending variation to sabaki", 1)
-        try:
-            self.wsHandler.write_message(json.dumps({"action": "play", "data": sgf}, separators=(",", ":") ))
-        except AttributeError:
-            trace("Warning : Couldn't send variation to Sabaki.", 0)
-        
-    def updateGameState(self, sgf):
-        self.gameState = sgf
+        delta = self.game.getVariationDelta(variationIndex)
+        if delta is None:
+            # The variation doesn't start from the main line, fall back to a full sgf and resync afterwards
+            sgf, nMoves = self.game.getVariation(variationIndex)
+            self.send({"action": "play", "data": sgf})
+            self.needsResync = True
+        else:
+            self.send({"action": "variation", "from": delta["from"], "nodes": delta["nodes"]})
+            self.variationOnBoard = True
+        
+    def updateGameState(self):
         self.update()
         
-    def requestVariation(self, sgf, user, nMoves):
-        self.variationsHandler.addVariation(sgf, user, nMoves)
+    def showVariation(self, entry):
+        """ Called by the display scheduler when a variation begins """
+        self.showingVariation = True
+        if self.paused or self.wsHandler is None or self.game is None:
+            return
+        with self.lock:
+            try:
+                self.sendMainLine()
+                self.sendVariation(entry.variationIndex)
+            except AttributeError:
+                trace("Warning : Couldn't send variation to Sabaki.", 0)
+                
+    def clearVariation(self):
+        """ Called by the display scheduler when no variation is displayed anymore """
+        self.showingVariation = False
         self.update()
         
     def update(self):
-        if self.showingVariation:
+        if self.paused:
             return
-        while self.paused:
-            time.sleep(1)
-        variation = self.variationsHandler.getVariation()
-        if variation is not None:
-            self.showingVariation = True
-            sgf, displayTime = variation
-            self.sendVariation(sgf)
-            timer = Timer(displayTime, self._endTimer)
-            timer.start()
-        elif self.gameState is not None:
-            self.sendGame(self.gameState)
-        
-    def _endTimer(self):
-        self.showingVariation = False
-        self.update()
+        if self.wsHandler is None or self.game is None:
+            return
+        with self.lock:
+            if self.showingVariation:
+                return
+            try:
+                self.sendMainLine()
+            except AttributeError:
+                trace("Warning : Couldn't send the game to Sabaki.", 0)
         
     def pauseComms(self):
         self.paused = True
         
     def resumeComms(self):
         self.paused = False
+        self.update()
     
 comInstance = SabakiCommunication()
 
@@ -155,6 +179,8 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         trace("Sabaki connection open", 0)
         comInstance.bindWsHandler(self)
         self.write_message(json.dumps({"action": "hi !"}, separators=(",", ":") ))
+        if not comInstance.paused:
+            comInstance.ioloop.add_callback(comInstance.update)
     
     def on_message(self, message):
         trace("From Sabaki : " + message, 1)
@@ -165,18 +191,15 @@ class WSHandler(tornado.websocket.WebSocketHandler):
     def check_origin(self, origin):
         return True
         
-def startSabakiCommunication():
-    application = tornado.web.Application( [(r'/', WSHandler), ] )
-        
-    http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(4257, address="localhost")
-    for sock in http_server._sockets.values():
-        trace(sock.getsockname(), 2)
-        trace("#####", 2)
-        
+def startSabakiCommunication(game):
+    comInstance.bindGame(game)
+    comInstance.listen()
+    displayScheduler.addOutput(comInstance)
     return comInstance
 
 
 if __name__ == "__main__":
-    inst = startSabakiCommunication()
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    from go_game import Game
+    import event_loop
+    inst = startSabakiCommunication(Game())
+    event_loop.eventLoopThread.join()
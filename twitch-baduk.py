@@ -7,7 +7,11 @@ from threading import Thread
 
 from twitch_bot import getTwitchBot
 from go_game import Game
+from event_loop import stopEventLoop
+from display_scheduler import displayScheduler
 from util import trace, settings
+
+BOT_STOP_TIMEOUT = 5
     
 class ProgramManager:
     def __init__(self):
@@ -25,8 +29,7 @@ class ProgramManager:
         if self.useSabaki:
             from game_capture import getScreenshotDaemon
             from sabaki_com import startSabakiCommunication
-            self.comThread = startSabakiCommunication()
-            self.comThread.start()
+            self.comThread = startSabakiCommunication(self.gameState)
             self.daemonThread = getScreenshotDaemon(self.gameState, self.twitchBot)
             self.daemonThread.start()
         
@@ -105,6 +108,9 @@ class ProgramManager:
     def endProgram(self):
         trace("Ending program", 0)
         self.twitchBot.stop()
+        # The bot disconnects on the event loop, which must still be running until then
+        if not self.twitchBot.join(BOT_STOP_TIMEOUT):
+            trace("Warning : the twitch bot didn't stop in time", 0)
         del self.twitchBot
         self.twitchBot = None
         if self.useSabaki:
@@ -115,6 +121,7 @@ class ProgramManager:
             self.comThread.stop()
             del self.comThread
             self.comThread = None
+        stopEventLoop()
     
     def toggleCommunication(self):
         if not self.useSabaki:
@@ -127,6 +134,15 @@ class ProgramManager:
             trace("Resuming updates to sabaki", 0)
             self.comThread.resumeComms()
             self.communicationActive = True
+    
+    def skipVariation(self):
+        displayScheduler.skip()
+    
+    def extendVariation(self):
+        displayScheduler.extend(settings["variation_extend_time"])
+    
+    def clearVariations(self):
+        displayScheduler.clear()
             
 if __name__ == "__main__":
     mgr = ProgramManager()
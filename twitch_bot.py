@@ -1,93 +1,227 @@
-import socket
 import re
 import os
-from threading import Thread, Timer
-import time
+from threading import Event
 import datetime
+import time
+
+from tornado import gen, locks
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
 
 from util import trace, letterToCol, settings
+from irc import IRCLineBuffer, RateLimiter, SendQueue, ReconnectBackoff
+from event_loop import getEventLoop
 from go_game import COLOR_BLACK, COLOR_WHITE, otherColor
 from board_overlay import VariationOverlayGenerator
+from display_scheduler import DisplayEntry, displayScheduler
 
-sabakiCom = None
+# Chat commands : [move N | variation N] [b | w] <coordinates ...>
+COMMAND_PREFIX = re.compile("(?:(move|variation) ([0-9]+) *)?(?:([bw]) (?=[a-z][0-9]))?")
+COMMAND_COORDINATES = re.compile("[a-z][0-9]{1,2}")
+DIGITS = "0123456789"
 
-class TwitchBot(Thread):
+class ChatCommand:
+    """ A variation posted in the chat """
+    def __init__(self, coords, color=0, origin=None, originNumber=None):
+        self.coords = coords
+        self.color = color
+        self.origin = origin
+        self.originNumber = originNumber
+
+def parseChatCommand(content):
+    """ Parses a chat message in a single pass, or gives None if it isn't a command """
+    # Every command has coordinates, so chat without any digit can be discarded right away
+    if not any(digit in content for digit in DIGITS):
+        return None
+    prefix = COMMAND_PREFIX.match(content)
+    coords = COMMAND_COORDINATES.findall(content, prefix.end())
+    if len(coords) == 0:
+        return None
+    origin, originNumber, color = prefix.groups()
+    if originNumber is not None:
+        originNumber = int(originNumber)
+    if color is not None:
+        color = COLOR_BLACK if color == "b" else COLOR_WHITE
+    return ChatCommand(coords, color or 0, origin, originNumber)
+
+class TwitchBot:
+    """ Twitch chat client running on the shared event loop, each line is handled as soon as it is received """
     
     def __init__(self, game):
-        super(TwitchBot, self).__init__()
         self.running = False
         self.game = game
         self.useServerCoordinates = settings["use_server_coordinates"]
         self.useSabaki = settings["use_sabaki"]
-        if self.useSabaki:
-            from sabaki_com import comInstance
-            global sabakiCom
-            sabakiCom = comInstance
         
         self.channel = settings["twitch_channel"]
-        self.refreshRate = settings["twitch_chat_refresh_delay"]
         self.socketBufferSize = settings["twitch_buffer_size"]
         self.servers = {}
         for serv in settings["servers"]:
             self.servers[serv["name"]] = {"i_col": serv["i_col"], "reversed_rows": serv["reversed_rows"]}
         self.currentServer = None
         self.lastPing = None
+        self.lineBuffer = IRCLineBuffer()
+        self.ioloop = None
+        self.stream = None
+        self.finished = Event()
+        
+        # Connection monitoring
+        self.pingInterval = settings["twitch_ping_interval"]
+        self.pingTimeout = settings["twitch_ping_timeout"]
+        self.backoff = ReconnectBackoff(settings["twitch_reconnect_min_delay"], settings["twitch_reconnect_max_delay"])
+        self.lastReceived = None
+        self.probeTimer = None
+        self.probeSent = False
+        self.reconnectCount = 0
+        self.downtime = 0
+        self.disconnectedSince = None
+        self.messagesPer30s = settings["twitch_messages_per_30s"]
+        self.acknowledgeVariations = settings["twitch_acknowledge_variations"]
+        self.sendQueue = None
+        self.acknowledgements = []
         
         self.overlayActive = settings["generate_overlay_image"]
         if self.overlayActive:
             self.variationOverlayGenerator = VariationOverlayGenerator()
-        
-        self.initSocket()
+            displayScheduler.addOutput(self.variationOverlayGenerator)
+        self.useBrowserOverlay = settings["overlay_browser_source"]
+        if self.useBrowserOverlay:
+            from browser_overlay import overlayInstance, startOverlayServer
+            displayScheduler.addOutput(overlayInstance)
+            if not self.useSabaki:
+                startOverlayServer()
         
         
 ##### IRC socket management #####
     
-    def initSocket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)
-        
+    @gen.coroutine
+    def connect(self):
+        """ Opens the connection to twitch chat and joins the channel, gives whether it succeeded """
+        # A connection stalling before the login is complete isn't watched by the liveness probe yet, so both steps are given a deadline
+        timeout = datetime.timedelta(seconds=self.pingTimeout)
         try:
-            sock.connect( (settings["twitch_host"], settings["twitch_port"]) )
-        except:
+            self.stream = yield gen.with_timeout(timeout, TCPClient().connect(settings["twitch_host"], settings["twitch_port"]))
+        except (IOError, gen.TimeoutError):
             trace("Cannot connect to server %s:%s" % (settings["twitch_host"], settings["twitch_port"]), 0)
-            return
-        
-        self.socket = sock    
-        # sock.settimeout(None)
+            raise gen.Return(False)
+        self.lineBuffer.clear()
         
         self.ircSend("PASS %s\r\n" % settings["twitch_bot_oauth"])
         self.ircSend("NICK %s\r\n" % settings["twitch_bot_name"])
         self.ircSend("USER %s 8 * %s\r\n" % (settings["twitch_bot_name"], settings["twitch_bot_name"]) )
         
-        data = sock.recv(1024)
-        if "Login unsuccessful" in data:
-            trace("Couldn't login to twitch chat, your bot's password is probably wrong.", 0)
-            return
-        else:
-            trace("Logged in to twitch chat.", 0)
+        try:
+            loggedIn = yield gen.with_timeout(timeout, self.login(), quiet_exceptions=StreamClosedError)
+        except gen.TimeoutError:
+            trace("No answer from twitch chat while logging in", 0)
+            self.stream.close()
+            raise gen.Return(False)
+        if not loggedIn:
+            raise gen.Return(False)
+        trace("Logged in to twitch chat.", 0)
             
+        self.joinChannel()
+        self.connectionRestored()
+        raise gen.Return(True)
+        
+    @gen.coroutine
+    def login(self):
+        """ Waits for the welcome message, twitch answers with a notice if the login failed """
+        while True:
+            data = yield self.stream.read_bytes(self.socketBufferSize, partial=True)
+            for message in self.lineBuffer.feed(data):
+                if message.command == "NOTICE" and "Login unsuccessful" in (message.trailing or ""):
+                    trace("Couldn't login to twitch chat, your bot's password is probably wrong.", 0)
+                    self.running = False
+                    self.stream.close()
+                    raise gen.Return(False)
+                if message.command == "001":
+                    raise gen.Return(True)
+        
+    def joinChannel(self):
         self.ircSend("JOIN #%s\r\n" % self.channel)
-        self.running = True
-        self.lastPing = datetime.datetime.now()
+        
+    def connectionRestored(self):
+        self.backoff.reset()
+        if self.disconnectedSince is not None:
+            elapsed = time.time() - self.disconnectedSince
+            self.downtime += elapsed
+            self.reconnectCount += 1
+            self.disconnectedSince = None
+            trace("Reconnected to twitch chat after %.1f seconds - %d reconnections and %.1f seconds of downtime so far" % (elapsed, self.reconnectCount, self.downtime), 0)
+        self.lastReceived = time.time()
+        self.scheduleProbe(self.pingInterval)
+        
+    def connectionLost(self):
+        if self.disconnectedSince is None and self.lastReceived is not None:
+            self.disconnectedSince = time.time()
+        self.cancelProbe()
+        
+    def connectionStats(self):
+        """ Number of reconnections and total time in seconds spent disconnected from the chat """
+        downtime = self.downtime
+        if self.disconnectedSince is not None:
+            downtime += time.time() - self.disconnectedSince
+        return {"reconnections": self.reconnectCount, "downtime": downtime}
+        
+    def scheduleProbe(self, delay):
+        self.cancelProbe()
+        self.probeTimer = self.ioloop.call_later(delay, self.checkConnection)
+        
+    def cancelProbe(self):
+        if self.probeTimer is not None:
+            self.ioloop.remove_timeout(self.probeTimer)
+            self.probeTimer = None
+        self.probeSent = False
         
     def checkConnection(self):
-        currentTime = datetime.datetime.now()
-        if (currentTime - self.lastPing).total_seconds() > 320:
-            trace("No ping received in the last 5 minutes, reconnecting to twitch chat ...", 0)
-            self.initSocket()
+        """ Liveness probe : after a while without receiving anything, sends our own PING, and reconnects if nothing came back in time """
+        self.probeTimer = None
+        silence = time.time() - self.lastReceived
+        if silence < self.pingInterval:
+            self.probeSent = False
+            self.probeTimer = self.ioloop.call_later(self.pingInterval - silence, self.checkConnection)
+        elif not self.probeSent:
+            trace("Nothing received from twitch chat for %d seconds, sending a ping" % silence, 2)
+            self.ircSend("PING :tmi.twitch.tv\r\n")
+            self.probeSent = True
+            self.probeTimer = self.ioloop.call_later(self.pingTimeout, self.checkConnection)
+        else:
+            trace("No answer from twitch chat, reconnecting ...", 0)
+            self.stream.close()
         
     def ircSend(self, message):
-        self.socket.send(message)
+        """ Sends a raw IRC message, from the event loop """
+        try:
+            self.stream.write(message.encode("utf-8"))
+        except StreamClosedError:
+            trace("Couldn't send message to twitch chat, the connection is closed.", 1)
         
     def writeMessage(self, message):
-        self.ircSend("PRIVMSG #%s :%s" % (self.channel, message))
+        """ Sends a chat message once the rate limit allows it, from the event loop """
+        self.sendQueue.send("PRIVMSG #%s :%s\r\n" % (self.channel, message))
         
-    def getIRCData(self):
-        try:
-            data = self.socket.recv(self.socketBufferSize)
-            return data
-        except socket.timeout:
-            trace("No message from twitch", 2)
+    def acknowledgeVariation(self, user, variationIndex):
+        """ Tells the chat a variation was queued. Acknowledgements waiting for the rate limit are merged into a single message. """
+        self.acknowledgements.append( (user, variationIndex) )
+        if len(self.acknowledgements) == 1:
+            self.sendQueue.send(self.acknowledgementMessage)
+            
+    def acknowledgementMessage(self):
+        acknowledgements = self.acknowledgements
+        self.acknowledgements = []
+        if len(acknowledgements) == 1:
+            user, variationIndex = acknowledgements[0]
+            text = "Queued variation %d from %s" % (variationIndex, user)
+        else:
+            users = []
+            for user, variationIndex in acknowledgements:
+                if user not in users:
+                    users.append(user)
+            text = "Queued %d variations : %s" % (len(acknowledgements), ", ".join(users[:10]))
+            if len(users) > 10:
+                text += " ..."
+        return "PRIVMSG #%s :%s\r\n" % (self.channel, text)
         
     def setCurrentServer(self, server):
         self.currentServer = server
@@ -95,22 +229,30 @@ class TwitchBot(Thread):
         
 ##### Bot functionalities #####
     
-    def getMessages(self):
-        # twitch message structure ->   :<user>!<user>@<user>.tmi.twitch.tv PRIVMSG #<channel> :This is a sample message
-        messages = []
-        data = self.getIRCData()
-        if data is None:
-            return messages
-        trace("Got message %s" % data, 2)
-        if "PING :tmi.twitch.tv" in data:
-            trace("Sending pong", 3)
-            self.ircSend("PONG :tmi.twitch.tv")
-        matches = re.findall(":(.+)\!(.+)\@(.+).tmi.twitch.tv PRIVMSG #%s :(.+)$" % self.channel, data, re.MULTILINE)
-        for match in matches:
-            user = match[0]
-            content = match[3].rstrip()
-            messages.append( (content.lower(), user) )
-        return messages
+    def getMessages(self, data):
+        """ Yields the (content, user) chat messages of the channel from the lines completed by the received data """
+        self.lastReceived = time.time()
+        for message in self.lineBuffer.feed(data):
+            trace("Got message %s" % message, 3)
+            if message.command == "PING":
+                trace("Sending pong", 3)
+                self.ircSend("PONG :%s\r\n" % message.trailing)
+                self.lastPing = datetime.datetime.now()
+            elif message.command == "PRIVMSG" and len(message.params) > 1 and message.params[0] == "#" + self.channel:
+                yield (message.trailing.rstrip().lower(), message.nick)
+            elif message.command == "RECONNECT":
+                trace("Twitch chat asked to reconnect", 0)
+                self.stream.close()
+            elif message.command == "PART" and message.nick == settings["twitch_bot_name"].lower():
+                trace("Left the channel, joining again", 0)
+                self.joinChannel()
+    
+    def handleMessages(self, data):
+        for message in self.getMessages(data):
+            try:
+                self.parseMessage(message)
+            except Exception as e:
+                trace("Couldn't handle message %s from %s : %s" % (message[0], message[1], e), 0)
     
     def parseCoordinates(self, coordsStr):
         col = int(letterToCol(coordsStr[0]))
@@ -133,73 +275,123 @@ class TwitchBot(Thread):
         content, user = message
         trace("Parsing message %s from %s" % (content, user), 2)
         # Check for game sequence
-        coordMatches = re.findall("[a-z][0-9]{1,2}", content)
-        trace(coordMatches, 1)
-        if len(coordMatches) > 0:
+        command = parseChatCommand(content)
+        if command is not None:
+            trace(command.coords, 1)
             trace("Found coordinates from twitch chat !", 1)
             
-            forcedColor = False
-            # Check if there is a color for the first move
-            if re.match("b [a-z][0-9]{1,2}", content):
-                firstMove = COLOR_BLACK
-                forcedColor = True
-            elif re.match("w [a-z][0-9]{1,2}", content):
-                firstMove = COLOR_WHITE
-                forcedColor = True
-            else:
-                firstMove = 0
+            forcedColor = command.color != 0
+            firstMove = command.color
             trace("First player %d" % firstMove, 2)
             
+            # Unless a color is given, the colors follow the move the variation starts from
+            try:
+                if command.origin is None:
+                    color = self.game.nextPlayer()
+                elif command.origin == "move":
+                    color = self.game.nextPlayerAfterMove(command.originNumber)
+                else:
+                    color = self.game.nextPlayerAfterVariation(command.originNumber)
+            except IndexError:
+                if command.origin == "move":
+                    trace("Unknown move %d" % command.originNumber, 1)
+                else:
+                    trace("Unknown variation %d" % command.originNumber, 1)
+                return
+            if firstMove != 0:
+                color = firstMove
+            
             # Change the coordinates into (col, row) tuples
             moves = []
-            color = self.game.nextPlayer() if firstMove == 0 else firstMove
-            for match in coordMatches:
+            for match in command.coords:
                 coords = self.parseCoordinates(match)
                 moves.append( (coords, color) )
                 color = otherColor(color)
             trace("Moves %s" % str(moves), 2)
             
-            # Check if the variation has a specific origin in the game tree, then send it to the game state
-            variationIndex = None
-            hasOrigin = re.match("(move)|(variation) ([0-9]+)", content)
-            if hasOrigin:
-                origin = re.match("move ([0-9]+)", content)
-                if not origin:
-                    variation = re.match("variation ([0-9]+)", content)
-                    variationNumber = int(variation[0])
-                    variationIndex = self.game.expandVariation(moves, variationNumber)
-                    trace("Expanding previous variation %d" % variationNumber, 1)
-                else:
-                    moveNumber = int(origin[0])
-                    variationIndex = self.game.addVariation(moves, moveNumber)
-                    trace("Creating variation %d from move %d" % (variationIndex, moveNumber), 1)
-            else:
+            # Send the variation to the game state
+            nVariations = len(self.game.variations)
+            if command.origin is None:
                 variationIndex = self.game.addVariation(moves)
                 trace("Creating variation %d" % variationIndex, 1)
+            elif command.origin == "move":
+                variationIndex = self.game.addVariation(moves, command.originNumber)
+                trace("Creating variation %d from move %d" % (variationIndex, command.originNumber), 1)
+            else:
+                variationIndex = self.game.expandVariation(moves, command.originNumber)
+                trace("Expanding previous variation %d into variation %d" % (command.originNumber, variationIndex), 1)
+            
+            if variationIndex < nVariations:
+                trace("Variation %d was already posted" % variationIndex, 1)
             
             # if len(moves) == 0 and not hasOrigin:   
                 # return
-            variationSgf, nMoves = self.game.getVariation(variationIndex)
-            if self.useSabaki:
-                sabakiCom.requestVariation(variationSgf, user, nMoves)
+            
+            # Nothing is acknowledged nor rendered for a variation that won't be displayed
+            entry = DisplayEntry(user, moves, forcedColor, variationIndex)
+            if not displayScheduler.acceptVariation(entry):
+                return
+            if self.acknowledgeVariations:
+                self.acknowledgeVariation(user, variationIndex)
+            
+            # Queue the variation for every output at once, the overlay image starts rendering right away
             if self.overlayActive:
-                self.variationOverlayGenerator.generateOverlay(moves, user, forcedColor)
+                entry.overlayImage = self.variationOverlayGenerator.generateOverlay(moves, user, forcedColor)
+            nMoves = self.game.variations[variationIndex][1]
+            displayScheduler.addVariation(entry, nMoves)
 
 ##### Bot management #####
     
+    @gen.coroutine
     def run(self):
         trace("Twitch bot start", 1)
         while self.running:
-            trace("Twitch bot update", 2)
-            messages = self.getMessages()
-            for message in messages:
-                self.parseMessage(message)
-            self.checkConnection()
-            time.sleep(self.refreshRate)
+            try:
+                connected = yield self.connect()
+                if connected:
+                    # Lines received along with the welcome message
+                    self.handleMessages(b"")
+                    while self.running:
+                        data = yield self.stream.read_bytes(self.socketBufferSize, partial=True)
+                        self.handleMessages(data)
+            except StreamClosedError:
+                trace("Connection to twitch chat lost", 0)
+            except Exception as e:
+                # Anything unexpected goes through the reconnection too, rather than leaving the chat unread
+                trace("Error in twitch chat connection : %s" % e, 0)
+                if self.stream is not None:
+                    self.stream.close()
+            self.connectionLost()
+            if self.running:
+                delay = self.backoff.nextDelay()
+                trace("Reconnecting to twitch chat in %.1f seconds ..." % delay, 0)
+                try:
+                    # Woken up early if the bot is stopped meanwhile
+                    yield self.stopping.wait(timeout=datetime.timedelta(seconds=delay))
+                except gen.TimeoutError:
+                    pass
         trace("Twitch bot end", 1)
+        self.finished.set()
+        
+    def start(self):
+        self.running = True
+        self.ioloop = getEventLoop()
+        self.stopping = locks.Event()
+        self.sendQueue = SendQueue(self.ircSend, self.ioloop, RateLimiter(self.messagesPer30s, 30))
+        self.ioloop.add_callback(self.run)
         
     def stop(self):
         self.running = False
+        self.ioloop.add_callback(self._stop)
+        
+    def _stop(self):
+        self.stopping.set()
+        if self.stream is not None:
+            self.stream.close()
+            
+    def join(self, timeout=None):
+        """ Waits for the bot to disconnect, gives whether it did within the timeout """
+        return self.finished.wait(timeout)
     
 
 def getTwitchBot(gameState):